@@ -1,25 +1,337 @@
+import io
+import os
+import re
+import csv
+import random
+import atexit
+import json
+import base64
 import uuid
 import hashlib
-from flask import Flask, render_template
+import tempfile
+import mimetypes
+import multiprocessing
+import threading
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import click
+from flask import Flask, abort, before_render_template, g, jsonify, redirect, render_template, request, stream_template, template_rendered, url_for
+from werkzeug.http import is_resource_modified
 import boto3
 import requests
-from botocore.exceptions import NoCredentialsError
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from caches import ListingCache, SQLiteListingCache, make_private_dir
+from jobs import JobQueue
+from logs import DroppingQueueHandler, JsonFormatter, RequestContextFilter, configure_logger
+from metrics import AWSCallMetrics, Metrics, current_request_timing
+from middleware import CompressionMiddleware, TimingMiddleware, start_render_timer, stop_render_timer
+
+# Pillow is only needed for resized gallery variants; without it images are
+# stored and shown at full size only
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 app = Flask(__name__)
 
+# Logs are JSON lines on stderr (see logs.py); when log_queue_size records are
+# waiting, new ones are dropped. log_sample_rate keeps that fraction of
+# requests' DEBUG/INFO records (all of a request's records or none); warnings
+# and errors are always kept.
+log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+log_sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+log_queue_size = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+request_id_header = 'X-Request-ID'
+
+log_handler = DroppingQueueHandler(log_queue_size)
+log_handler.setFormatter(JsonFormatter())
+log_handler.addFilter(RequestContextFilter(log_sample_rate))
+logger = configure_logger(__name__, log_level, log_handler)
+configure_logger('caches', log_level, log_handler)
+atexit.register(log_handler.stop_listener)
+
+@app.before_request
+def start_request_logging():
+    # Reuse the caller's request ID (e.g. from a load balancer) when it is sane
+    request_id = request.headers.get(request_id_header, '')
+    if not (0 < len(request_id) <= 128 and request_id.isprintable()):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+    g.log_sampled = random.random() < log_sample_rate
+    # Label the request's timings with its route pattern, not its URL
+    timing = current_request_timing()
+    if timing is not None and request.url_rule is not None:
+        timing['route'] = request.url_rule.rule
+
+@app.after_request
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers[request_id_header] = g.request_id
+    return response
+
 
 test_user='example_user'
 test_password='example_password'
 login_credentials_table_name = 'login-credentials'
 approved_images_table_name = 'approved-vehicles'
 approved_images_bucket_name = "approved-vehicle-images-3632442"
+image_hashes_table_name = 'image-hashes'
+# Every gallery image shares one partition of the gallery index, sorted by upload time
+gallery_index_name = 'gallery-index'
+gallery_partition = 'approved'
+# Attributes the gallery actually renders, read from the gallery index
+gallery_attributes = ['image_id', 'image_filename', 'image_url', 'username', 'uploaded_at', 'variants']
 initial_image_url = "https://www.linearity.io/blog/content/images/2023/06/how-to-create-a-car-NewBlogCover.png"
 
+# Gallery paging: default number of images per page and the most a client may ask for
+gallery_page_size = int(os.environ.get('GALLERY_PAGE_SIZE', '50'))
+gallery_max_page_size = 1000
+# Cache-Control for gallery pages; conditional requests are answered with 304
+# from the page's ETag/Last-Modified without rendering the template
+gallery_cache_max_age = int(os.environ.get('GALLERY_CACHE_MAX_AGE', '30'))
+gallery_cache_stale_while_revalidate = int(os.environ.get('GALLERY_CACHE_STALE_WHILE_REVALIDATE', '60'))
+
+# Pages of at least gallery_stream_threshold images are streamed: the index is
+# queried gallery_stream_chunk_size items at a time while the template renders,
+# and rendered HTML is sent in gallery_stream_buffer_size byte pieces
+gallery_stream_threshold = int(os.environ.get('GALLERY_STREAM_THRESHOLD', '200'))
+gallery_stream_chunk_size = int(os.environ.get('GALLERY_STREAM_CHUNK_SIZE', '100'))
+gallery_stream_buffer_size = int(os.environ.get('GALLERY_STREAM_BUFFER_SIZE', '8192'))
+
+# Text responses are compressed with brotli (when installed) or gzip, whichever
+# the client prefers. Bodies smaller than compression_min_size are sent as-is.
+compression_enabled = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+compression_min_size = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+gzip_level = int(os.environ.get('GZIP_LEVEL', '6'))
+brotli_quality = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+# Gallery listing cache: pages are fresh for listing_cache_ttl seconds, then served
+# stale for up to listing_cache_stale_ttl more while a background refresh runs
+listing_cache_ttl = float(os.environ.get('LISTING_CACHE_TTL', '30'))
+listing_cache_stale_ttl = float(os.environ.get('LISTING_CACHE_STALE_TTL', '300'))
+listing_cache_max_entries = int(os.environ.get('LISTING_CACHE_MAX_ENTRIES', '256'))
+# Threads per worker refreshing stale pages in the background
+listing_cache_refresh_workers = int(os.environ.get('LISTING_CACHE_REFRESH_WORKERS', '2'))
+# 'memory' keeps a cache per worker; 'sqlite' shares one cache file between all
+# workers on the host so each page is queried once per host per TTL
+listing_cache_backend = os.environ.get('LISTING_CACHE_BACKEND', 'memory')
+# Local state (the shared listing cache, the job queue and spooled uploads) is
+# kept in a directory only this user can write to, created on first use
+state_dir = os.environ.get('STATE_DIR', os.path.join(tempfile.gettempdir(), f'approved-vehicles-{os.getuid()}'))
+listing_cache_path = os.environ.get('LISTING_CACHE_PATH', os.path.join(state_dir, 'listing-cache.sqlite3'))
+
+# Uploads stream into S3 through s3transfer; files above the threshold are sent
+# as concurrent multipart chunks so no worker ever holds a whole image in memory
+upload_max_bytes = int(os.environ.get('UPLOAD_MAX_BYTES', str(50 * 1024 * 1024)))
+allowed_image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+transfer_config = TransferConfig(
+    multipart_threshold=int(os.environ.get('UPLOAD_MULTIPART_THRESHOLD', str(8 * 1024 * 1024))),
+    multipart_chunksize=int(os.environ.get('UPLOAD_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024))),
+    max_concurrency=int(os.environ.get('UPLOAD_MAX_CONCURRENCY', '4'))
+)
+
+# Images are hashed in chunks of this size; streams that cannot be rewound are
+# spooled to a temporary file (in memory up to hash_spool_max_memory bytes)
+hash_chunk_size = 1024 * 1024
+hash_spool_max_memory = int(os.environ.get('HASH_SPOOL_MAX_MEMORY', str(1024 * 1024)))
+
+# Gallery images are served through presigned GET URLs so the bucket can stay
+# private. A URL signed for a key is reused for presign_window seconds, which
+# leaves every cached URL valid for at least presigned_get_expiry - presign_window.
+presign_image_urls = os.environ.get('PRESIGN_IMAGE_URLS', 'true').lower() == 'true'
+presigned_get_expiry = int(os.environ.get('PRESIGNED_GET_EXPIRY', '3600'))
+presign_window = int(os.environ.get('PRESIGN_WINDOW', '900'))
+presign_cache_size = int(os.environ.get('PRESIGN_CACHE_SIZE', '8192'))
+
+# Resized copies of every image, by name and maximum width, stored under
+# variants_prefix and offered to browsers through srcset
+image_variant_widths = {'thumb': 320, 'medium': 1024}
+variants_prefix = 'variants/'
+variant_format = os.environ.get('VARIANT_FORMAT', 'WEBP').upper()
+variant_quality = int(os.environ.get('VARIANT_QUALITY', '80'))
+
+# Browsers can also upload straight to the bucket with a presigned POST policy,
+# restricted to this key prefix, image content types and upload_max_bytes
+direct_upload_prefix = 'uploads/'
+presigned_post_expiry = int(os.environ.get('PRESIGNED_POST_EXPIRY', '600'))
+direct_upload_allowed_origins = os.environ.get('DIRECT_UPLOAD_ALLOWED_ORIGINS', '*').split(',')
+
+# Reject oversized request bodies before they are read
+app.config['MAX_CONTENT_LENGTH'] = upload_max_bytes
+
+# Provisioning waits on botocore waiters: seconds between polls and how many polls
+# before giving up
+provision_waiter_delay = int(os.environ.get('PROVISION_WAITER_DELAY', '2'))
+provision_waiter_max_attempts = int(os.environ.get('PROVISION_WAITER_MAX_ATTEMPTS', '150'))
+
+# Bucket teardown deletes keys in DeleteObjects batches fanned out over a thread pool
+delete_batch_size = 1000
+delete_max_workers = int(os.environ.get('DELETE_MAX_WORKERS', '8'))
+
+# Images fetched from URLs are streamed into S3 through one shared HTTP session,
+# with connect/read timeouts and a cap on the number of bytes accepted
+ingest_connect_timeout = float(os.environ.get('INGEST_CONNECT_TIMEOUT', '5'))
+ingest_read_timeout = float(os.environ.get('INGEST_READ_TIMEOUT', '30'))
+ingest_max_bytes = int(os.environ.get('INGEST_MAX_BYTES', str(upload_max_bytes)))
+ingest_pool_connections = int(os.environ.get('INGEST_POOL_CONNECTIONS', '10'))
+
+# Bulk imports: download threads, and how many entries are imported between
+# checkpoint writes
+import_max_workers = int(os.environ.get('IMPORT_MAX_WORKERS', '16'))
+import_checkpoint_every = int(os.environ.get('IMPORT_CHECKPOINT_EVERY', '200'))
+
+# Metadata writes are buffered and sent as BatchWriteItem requests of up to 25
+# items, at least every metadata_flush_interval seconds; unprocessed items are
+# retried with jittered exponential backoff
+metadata_batch_size = 25
+metadata_flush_interval = float(os.environ.get('METADATA_FLUSH_INTERVAL', '1'))
+metadata_max_attempts = int(os.environ.get('METADATA_MAX_ATTEMPTS', '8'))
+metadata_backoff_base = float(os.environ.get('METADATA_BACKOFF_BASE', '0.05'))
+metadata_backoff_max = float(os.environ.get('METADATA_BACKOFF_MAX', '5'))
+
+# Primary key attributes of each table, used to drop duplicate puts from a batch
+table_key_attributes = {
+    'approved-vehicles': ('image_filename', 'username'),
+    'login-credentials': ('username',)
+}
+
+# Image processing runs off the request path: uploads are spooled to disk and
+# queued in a SQLite job queue consumed by 'flask run-jobs'. Failed jobs are
+# retried with exponential backoff and dead-lettered after job_max_attempts.
+job_queue_path = os.environ.get('JOB_QUEUE_PATH', os.path.join(state_dir, 'jobs.sqlite3'))
+upload_spool_dir = os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(state_dir, 'uploads'))
+job_max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+job_retry_delay = float(os.environ.get('JOB_RETRY_DELAY', '5'))
+job_timeout = float(os.environ.get('JOB_TIMEOUT', '600'))
+job_poll_interval = float(os.environ.get('JOB_POLL_INTERVAL', '1'))
+job_max_workers = int(os.environ.get('JOB_MAX_WORKERS', str(os.cpu_count() or 2)))
+
+# Shared settings for every boto3 client and resource, tunable per deployment
+aws_region = os.environ.get('AWS_REGION')
+boto_config = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '25')),
+    retries={
+        'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', '5')),
+        'mode': os.environ.get('AWS_RETRY_MODE', 'standard')
+    },
+    tcp_keepalive=os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+)
+# SigV4 for S3 so presigned URLs work in every region and for up to seven days
+s3_config = boto_config.merge(Config(signature_version='s3v4'))
+
+# Histogram buckets, in seconds, for AWS call latencies
+aws_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Request latency percentiles are computed over each route's last
+# summary_window requests
+request_duration_quantiles = (0.5, 0.9, 0.99)
+summary_window = int(os.environ.get('METRICS_SUMMARY_WINDOW', '1024'))
+# Add a Server-Timing header splitting each response's time into AWS calls,
+# template rendering and the rest of the app
+server_timing_enabled = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+
+metrics = Metrics(summary_window)
+metrics.describe('aws_request_duration_seconds', 'histogram', "AWS API call latency, including retries.", aws_latency_buckets)
+metrics.describe('aws_requests_total', 'counter', "AWS API calls by outcome: ok or the error code.")
+metrics.describe('aws_retries_total', 'counter', "Retried attempts of AWS API calls.")
+metrics.describe('aws_request_bytes_total', 'counter', "Request body bytes sent to AWS.")
+metrics.describe('aws_response_bytes_total', 'counter', "Response body bytes returned by AWS.")
+metrics.describe('http_request_duration_seconds', 'summary', "Request wall time by route.", request_duration_quantiles)
+metrics.describe('http_request_phase_seconds_total', 'counter', "Request wall time by route, split into aws, render and app.")
+os.register_at_fork(after_in_child=metrics.reset)
+aws_call_metrics = AWSCallMetrics(metrics)
+
+# Process-wide registry of long-lived boto3 clients. Clients are thread-safe and
+# shared by every thread; resources are not, so each thread gets its own.
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+_thread_resources = threading.local()
+
+def get_session():
+    global _session
+    with _clients_lock:
+        if _session is None:
+            _session = boto3.session.Session(region_name=aws_region)
+            # Clients copy the session's handlers when they are created
+            aws_call_metrics.register(_session.events)
+        return _session
+
+def get_client(service_name, region_name=None):
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session()
+        # Sessions are not thread-safe, so clients are only ever built under the lock
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                config = s3_config if service_name == 's3' else boto_config
+                client = session.client(service_name, region_name=region_name, config=config)
+                _clients[key] = client
+    return client
+
+def get_resource(service_name, region_name=None):
+    resources = getattr(_thread_resources, 'resources', None)
+    if resources is None:
+        resources = _thread_resources.resources = {}
+    key = (service_name, region_name)
+    resource = resources.get(key)
+    if resource is None:
+        session = get_session()
+        with _clients_lock:
+            config = s3_config if service_name == 's3' else boto_config
+            resource = session.resource(service_name, region_name=region_name, config=config)
+        resources[key] = resource
+    return resource
+
+_http_session = None
+
+def get_http_session():
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=ingest_pool_connections, pool_maxsize=ingest_pool_connections)
+            _http_session.mount('https://', adapter)
+            _http_session.mount('http://', adapter)
+        return _http_session
+
+def reset_clients():
+    # Connection pools must never be shared across a fork, so every worker
+    # process starts with an empty registry and builds its own clients. The
+    # lock is replaced too, in case another thread held it during the fork.
+    global _session, _clients, _clients_lock, _thread_resources, _http_session
+    _clients_lock = threading.Lock()
+    _session = None
+    _clients = {}
+    _thread_resources = threading.local()
+    _http_session = None
+
+os.register_at_fork(after_in_child=reset_clients)
+
+def init_worker():
+    # Called by gunicorn's post_fork hook in every worker (see gunicorn.conf.py).
+    # With preload_app the app is imported once in the master, which never
+    # creates clients; each worker then builds its own registry up front so
+    # the first requests do not pay for loading the service models. Resources
+    # stay per thread and are built by each request thread on first use.
+    reset_clients()
+    get_client('s3')
+    get_client('dynamodb')
+
 def does_table_exist(table_name):
-    # Create a DynamoDB client
-    dynamodb = boto3.client('dynamodb')
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
 
     # Check if the table exists
     try:
@@ -28,27 +340,25 @@ def does_table_exist(table_name):
     except dynamodb.exceptions.ResourceNotFoundException:
         return False
 
+def waiter_config():
+    return {'Delay': provision_waiter_delay, 'MaxAttempts': provision_waiter_max_attempts}
+
 def wait_for_table_creation(table_name):
-    # Create a DynamoDB client
-    dynamodb = boto3.client('dynamodb')
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
 
-    while True:
-        try:
-            # Check the table status
-            response = dynamodb.describe_table(TableName=table_name)
-            status = response['Table']['TableStatus']
+    # Block until the table is ACTIVE
+    dynamodb.get_waiter('table_exists').wait(TableName=table_name, WaiterConfig=waiter_config())
+    logger.info("DynamoDB table is active", extra={'table': table_name})
 
-            # If the status is 'ACTIVE', break out of the loop
-            if status == 'ACTIVE':
-                break
-        except dynamodb.exceptions.ResourceNotFoundException:
-            pass  # Table not found, continue waiting
+def wait_for_bucket_creation(bucket_name):
+    s3 = get_client('s3')
 
-        # Sleep for a short duration before checking again
-        time.sleep(5)
+    s3.get_waiter('bucket_exists').wait(Bucket=bucket_name, WaiterConfig=waiter_config())
+    logger.info("S3 bucket is available", extra={'bucket': bucket_name})
 
 def does_bucket_exist(bucket_name):
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     try:
         s3.head_bucket(Bucket=bucket_name)
         return True
@@ -56,123 +366,854 @@ def does_bucket_exist(bucket_name):
         return False
 
 def does_object_exist(bucket_name, object_key):
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     try:
         s3.head_object(Bucket=bucket_name, Key=object_key)
         return True
     except Exception as e:
         return False
 
-def add_approved_vehicle_image(username, filename, image_url):
-    # Create a DynamoDB resource
-    dynamodb = boto3.resource('dynamodb')
+def does_bucket_cors_exist(bucket_name):
+    s3 = get_client('s3')
+    try:
+        s3.get_bucket_cors(Bucket=bucket_name)
+        return True
+    except Exception as e:
+        return False
+
+def configure_bucket_cors(bucket_name):
+    # Allow browsers to POST uploads straight to the bucket
+    s3 = get_client('s3')
+    try:
+        s3.put_bucket_cors(
+            Bucket=bucket_name,
+            CORSConfiguration={
+                'CORSRules': [
+                    {
+                        'AllowedMethods': ['POST'],
+                        'AllowedOrigins': direct_upload_allowed_origins,
+                        'AllowedHeaders': ['*'],
+                        'MaxAgeSeconds': 3000
+                    }
+                ]
+            }
+        )
+        logger.info("CORS configured on S3 bucket", extra={'bucket': bucket_name})
+    except Exception as e:
+        logger.error("Error configuring CORS on S3 bucket", extra={'bucket': bucket_name, 'error': str(e)})
+
+def build_approved_vehicle_item(username, filename, image_url, image_id=None, variants=None):
+    item = {
+        # Generate a UUID as the image_id unless the caller already has one
+        'image_id': image_id or str(uuid.uuid4()),
+        'username': username,
+        'image_filename': filename,
+        'image_url': image_url,
+        # Keys of the gallery index
+        'gallery': gallery_partition,
+        'uploaded_at': datetime.utcnow().isoformat()
+    }
+    if variants:
+        item['variants'] = variants
+    return item
+
+def item_key(table_name, item):
+    # (table_name, *key attributes) identifying an item in the metadata writer
+    return (table_name,) + tuple(item[name] for name in table_key_attributes[table_name])
+
+class MetadataWriter:
+    # Write-behind buffer for DynamoDB puts. Items are coalesced into
+    # BatchWriteItem requests by a background thread, flushed when a batch
+    # fills up, after flush_interval seconds, on demand and at exit. An item's
+    # on_written callback runs once the item is stored, never if it fails.
+
+    def __init__(self, batch_size, flush_interval, max_attempts, on_flush=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.on_flush = on_flush
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._counters = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed': 0
+        }
+
+    def put(self, table_name, item, on_written=None):
+        with self._condition:
+            self._ensure_thread()
+            self._pending.append((table_name, item, on_written))
+            self._counters['queued'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
 
+    def _ensure_thread(self):
+        # Threads do not survive a fork, so each worker starts its own flusher
+        if self._thread is None or self._thread_pid != os.getpid():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._pending) >= self.batch_size, timeout=self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing metadata writes")
+
+    def flush(self):
+        # Write everything buffered so far; returns once it is stored or has
+        # been reported as failed
+        with self._flush_lock:
+            with self._condition:
+                pending, self._pending = self._pending, []
+            for batch in iter_batches(pending, self.batch_size):
+                self._write_batch(batch)
+            if pending and self.on_flush is not None:
+                self.on_flush({table_name for table_name, item, on_written in pending})
+
+    def _write_batch(self, batch):
+        # BatchWriteItem rejects two puts for the same key, so keep the latest
+        latest = {}
+        callbacks = {}
+        for table_name, item, on_written in batch:
+            key = item_key(table_name, item)
+            latest[key] = (table_name, item)
+            if on_written is not None:
+                callbacks.setdefault(key, []).append(on_written)
+        request_items = {}
+        for table_name, item in latest.values():
+            request_items.setdefault(table_name, []).append({'PutRequest': {'Item': item}})
+        item_count = len(latest)
+
+        # The resource's client serialises plain Python values like Table does
+        dynamodb = get_resource('dynamodb').meta.client
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self._count('retries')
+                time.sleep(random.uniform(0, min(metadata_backoff_max, metadata_backoff_base * 2 ** attempt)))
+            try:
+                response = dynamodb.batch_write_item(RequestItems=request_items)
+            except (BotoCoreError, ClientError) as e:
+                logger.warning("Error writing metadata batch", extra={'attempt': attempt + 1, 'error': str(e)})
+                continue
+            self._count('batches')
+            request_items = response.get('UnprocessedItems') or {}
+            if not request_items:
+                self._count('written', item_count)
+                self._notify_written(callbacks, set())
+                return
+
+        failed_keys = {
+            item_key(table_name, write['PutRequest']['Item'])
+            for table_name, writes in request_items.items() for write in writes
+        }
+        self._count('written', item_count - len(failed_keys))
+        self._count('failed', len(failed_keys))
+        # Name every item that was lost, not just how many
+        unprocessed = [
+            dict({'table': table_name}, **{name: write['PutRequest']['Item'][name] for name in table_key_attributes[table_name]})
+            for table_name, writes in request_items.items() for write in writes
+        ]
+        logger.error("Gave up writing metadata items", extra={'items': len(failed_keys), 'attempts': self.max_attempts, 'unprocessed': unprocessed})
+        self._notify_written(callbacks, failed_keys)
+
+    def _notify_written(self, callbacks, failed_keys):
+        for key, on_written in callbacks.items():
+            if key in failed_keys:
+                continue
+            for callback in on_written:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Error in metadata write callback")
+
+    def _count(self, name, amount=1):
+        with self._condition:
+            self._counters[name] += amount
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+            return stats
+
+def on_metadata_flush(table_names):
+    # The gallery must show new images on the next page view
+    if approved_images_table_name in table_names:
+        listing_cache.invalidate()
+
+metadata_writer = MetadataWriter(metadata_batch_size, metadata_flush_interval, metadata_max_attempts, on_flush=on_metadata_flush)
+atexit.register(metadata_writer.flush)
+
+def add_approved_vehicle_image(username, filename, image_url, image_id=None, variants=None, on_written=None):
     # Specify the table name
     table_name = 'approved-vehicles'
 
-    try:
-        # Get the DynamoDB table
-        table = dynamodb.Table(table_name)
+    # Queue the item for the next batch write to the table
+    item = build_approved_vehicle_item(username, filename, image_url, image_id, variants)
+    metadata_writer.put(table_name, item, on_written)
+    logger.debug("Item queued", extra={'table': table_name, 'image_id': item['image_id']})
+    return item['image_id']
 
-        # Generate a UUID as the image_id
-        image_id = str(uuid.uuid4())
+def new_image_key(extension):
+    # Generate a unique filename using the current UTC time (including milliseconds),
+    # plus a random suffix so concurrent uploads never collide
+    current_time = datetime.utcnow()
+    return f"image_{current_time.strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:8]}{extension}"
+
+def s3_object_url(bucket_name, object_key):
+    return f"https://{bucket_name}.s3.amazonaws.com/{object_key}"
+
+@lru_cache(maxsize=presign_cache_size)
+def presigned_image_url(bucket_name, object_key, window):
+    # window is only part of the cache key: every call in the same window
+    # returns the same URL instead of computing a new SigV4 signature
+    s3 = get_client('s3')
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket_name, 'Key': object_key},
+        ExpiresIn=presigned_get_expiry
+    )
+
+def current_presign_window():
+    return int(time.time() // presign_window)
 
-        # Insert the item into the table
-        response = table.put_item(
+def image_url_for_key(object_key, bucket_name=approved_images_bucket_name):
+    # URL the browser should load an image from
+    if not presign_image_urls:
+        return s3_object_url(bucket_name, object_key)
+    return presigned_image_url(bucket_name, object_key, current_presign_window())
+
+def upload_image_fileobj(fileobj, bucket_name, object_key, content_type):
+    # Stream a file-like object into S3, switching to multipart above the
+    # configured threshold, and return the URL of the new object
+    s3 = get_client('s3')
+
+    s3.upload_fileobj(
+        fileobj,
+        bucket_name,
+        object_key,
+        ExtraArgs={'ContentType': content_type},
+        Config=transfer_config
+    )
+    logger.info("Image uploaded to S3", extra={'bucket': bucket_name, 'key': object_key})
+    return s3_object_url(bucket_name, object_key)
+
+class LimitedReader:
+    # File-like wrapper that refuses to read more than max_bytes from a stream
+
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        # urllib3 only treats None, not -1, as "read everything"
+        data = self.stream.read(size if size is not None and size >= 0 else None)
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            raise ValueError(f"Stream is larger than {self.max_bytes} bytes")
+        return data
+
+@contextmanager
+def open_image_url(image_url):
+    # Open a streaming download of an image, yielding a size-limited reader
+    # and the content type; the connection goes back to the pool on exit
+    session = get_http_session()
+
+    with session.get(image_url, stream=True, timeout=(ingest_connect_timeout, ingest_read_timeout)) as response:
+        response.raise_for_status()
+
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and int(content_length) > ingest_max_bytes:
+            raise ValueError(f"Image at {image_url} is larger than {ingest_max_bytes} bytes")
+
+        content_type = response.headers.get('Content-Type', 'application/octet-stream').split(';')[0]
+        response.raw.decode_content = True
+        yield LimitedReader(response.raw, ingest_max_bytes), content_type
+
+def url_extension(image_url, default='.png'):
+    extension = os.path.splitext(urlparse(image_url).path)[1].lower()
+    return extension if extension in allowed_image_extensions else default
+
+def ingest_image_from_url(image_url, bucket_name, username):
+    # Stream an image from a URL into S3 without holding the whole download
+    # in memory, returning the stored (or already known) image
+    with open_image_url(image_url) as (stream, content_type):
+        return store_image(stream, username, url_extension(image_url), content_type, bucket_name)
+
+@contextmanager
+def hashed_image(stream):
+    # Compute the SHA-256 of an image in constant memory and yield a seekable
+    # file positioned at its start together with the hex digest. Seekable
+    # inputs are read twice in place; anything else is copied to a spooled
+    # temporary file while it is hashed.
+    digest = hashlib.sha256()
+    if hasattr(stream, 'seekable') and stream.seekable():
+        start = stream.tell()
+        for chunk in iter(lambda: stream.read(hash_chunk_size), b''):
+            digest.update(chunk)
+        stream.seek(start)
+        yield stream, digest.hexdigest()
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=hash_spool_max_memory) as spooled:
+        for chunk in iter(lambda: stream.read(hash_chunk_size), b''):
+            digest.update(chunk)
+            spooled.write(chunk)
+        spooled.seek(0)
+        yield spooled, digest.hexdigest()
+
+def image_key_for_hash(content_hash, extension):
+    # Objects are keyed by content so identical images share one key
+    return f"image_{content_hash}{extension}"
+
+def claim_image_hash(content_hash, image_id, object_key, username):
+    # Record content_hash -> image_id unless the hash is already known.
+    # Returns None when the claim succeeded, or the existing claim. A claim is
+    # only complete once its approved-vehicles item has been written (see
+    # complete_image_hash); claims from before this flag existed have no
+    # 'complete' attribute and were always written.
+    table = get_resource('dynamodb').Table(image_hashes_table_name)
+
+    try:
+        table.put_item(
             Item={
+                'content_hash': content_hash,
                 'image_id': image_id,
+                'image_filename': object_key,
                 'username': username,
-                'image_filename': filename,
-                'image_url': image_url
-            }
+                'complete': False
+            },
+            ConditionExpression='attribute_not_exists(content_hash)',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
         )
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if 'Item' not in e.response:
+            return table.get_item(Key={'content_hash': content_hash}, ConsistentRead=True).get('Item', {})
+        # Items on errors are not deserialised by the Table resource
+        deserializer = TypeDeserializer()
+        return {name: deserializer.deserialize(value) for name, value in e.response['Item'].items()}
 
-        print(f"Item added to '{table_name}' table: {response}")
+def is_complete_claim(claim):
+    return claim.get('complete', True)
 
+def complete_image_hash(content_hash, image_id):
+    # Mark a claim complete once its image is in the gallery; from then on the
+    # hash counts as a duplicate for every other upload
+    table = get_resource('dynamodb').Table(image_hashes_table_name)
+
+    try:
+        table.update_item(
+            Key={'content_hash': content_hash},
+            UpdateExpression='SET #complete = :complete',
+            ConditionExpression='image_id = :image_id',
+            ExpressionAttributeNames={'#complete': 'complete'},
+            ExpressionAttributeValues={':complete': True, ':image_id': image_id}
+        )
     except Exception as e:
-        print(f"Error adding item to '{table_name}' table: {e}")
+        # The claim stays incomplete, so the next upload of the image
+        # rewrites the same item and tries again
+        logger.error("Error completing image hash", extra={'content_hash': content_hash, 'error': str(e)})
 
+def release_image_hash(content_hash, image_id):
+    # Undo a claim whose upload failed, so the image can be uploaded again
+    table = get_resource('dynamodb').Table(image_hashes_table_name)
 
-def create_s3_bucket_and_upload_image(bucket_name, initial_image_url, test_user):
-    s3 = boto3.client('s3')
+    try:
+        table.delete_item(
+            Key={'content_hash': content_hash},
+            ConditionExpression='image_id = :image_id',
+            ExpressionAttributeValues={':image_id': image_id}
+        )
+    except Exception as e:
+        logger.error("Error releasing image hash", extra={'content_hash': content_hash, 'error': str(e)})
+
+def store_image(stream, username, extension, content_type, bucket_name=approved_images_bucket_name, image_id=None):
+    # Store an image once per distinct content. The object is keyed by the
+    # SHA-256 of its bytes and a conditional write on the hash table decides
+    # whether it is new; duplicates of a complete claim skip the S3 PUT and
+    # metadata write and return the image that is already stored. An
+    # incomplete claim (a retry of this image, or an attempt that died before
+    # its metadata was written) is finished under the claim's own image_id,
+    # username and key, so running this again always converges on one item.
+    requested_image_id = image_id = image_id or str(uuid.uuid4())
+    with hashed_image(stream) as (fileobj, content_hash):
+        object_key = image_key_for_hash(content_hash, extension)
+
+        existing = claim_image_hash(content_hash, image_id, object_key, username)
+        if existing is not None:
+            if is_complete_claim(existing) and existing.get('image_id') != image_id:
+                logger.info("Duplicate image already stored", extra={'content_hash': content_hash, 'image_filename': existing.get('image_filename')})
+                return {
+                    'image_id': existing.get('image_id'),
+                    'image_filename': existing.get('image_filename'),
+                    'image_url': s3_object_url(bucket_name, existing.get('image_filename')),
+                    'duplicate': True
+                }
+            image_id, object_key = existing['image_id'], existing['image_filename']
+            username = existing.get('username', username)
+
+        try:
+            image_url = upload_image_fileobj(fileobj, bucket_name, object_key, content_type)
+        except Exception:
+            if existing is None:
+                release_image_hash(content_hash, image_id)
+            raise
+
+        variants = generate_image_variants(fileobj, object_key, bucket_name)
+
+    add_approved_vehicle_image(
+        username, object_key, image_url, image_id, variants,
+        on_written=partial(complete_image_hash, content_hash, image_id)
+    )
+    return {
+        'image_id': image_id,
+        'image_filename': object_key,
+        'image_url': image_url,
+        'duplicate': image_id != requested_image_id
+    }
+
+def generate_image_variants(fileobj, object_key, bucket_name=approved_images_bucket_name):
+    # Produce and upload the resized variants of an image, returning a map of
+    # variant name -> {'key', 'width'} that also describes the original. Best
+    # effort: an image that cannot be resized is simply served at full size.
+    if Image is None:
+        return {}
+
+    extension = 'webp' if variant_format == 'WEBP' else 'jpg'
+    content_type = 'image/webp' if variant_format == 'WEBP' else 'image/jpeg'
+    stem = os.path.splitext(object_key)[0]
+    try:
+        fileobj.seek(0)
+        with Image.open(fileobj) as source:
+            # Variants are saved without EXIF, so rotate them as the Orientation
+            # tag says; browsers apply it to the original, hence its width too
+            image = ImageOps.exif_transpose(source)
+            variants = {'original': {'key': object_key, 'width': image.width}}
+            for name, width in image_variant_widths.items():
+                if image.width <= width:
+                    continue
+                variant = image.copy()
+                variant.thumbnail((width, variant.height))
+                if variant_format == 'JPEG' and variant.mode != 'RGB':
+                    variant = variant.convert('RGB')
 
+                buffer = io.BytesIO()
+                variant.save(buffer, format=variant_format, quality=variant_quality)
+                buffer.seek(0)
+                variant_key = f"{variants_prefix}{stem}/{name}.{extension}"
+                upload_image_fileobj(buffer, bucket_name, variant_key, content_type)
+                variants[name] = {'key': variant_key, 'width': variant.width}
+            return variants
+    except Exception as e:
+        logger.error("Error generating variants", extra={'key': object_key, 'error': str(e)})
+        return {}
+
+def create_s3_bucket(bucket_name):
+    s3 = get_client('s3')
+
+    try:
+        s3.create_bucket(Bucket=bucket_name)
+        logger.info("S3 bucket created", extra={'bucket': bucket_name})
+    except Exception as e:
+        logger.error("Error creating S3 bucket", extra={'bucket': bucket_name, 'error': str(e)})
+        return False
+    configure_bucket_cors(bucket_name)
+    return True
+
+def create_s3_bucket_and_upload_image(bucket_name, initial_image_url, test_user):
     # Check if the bucket exists
     if not does_bucket_exist(bucket_name):
-        try:
-            s3.create_bucket(Bucket=bucket_name)
-            print(f"S3 bucket '{bucket_name}' created successfully.")
-        except Exception as e:
-            print(f"Error creating S3 bucket: {e}")
+        if not create_s3_bucket(bucket_name):
             return
 
-    # Generate a unique filename using the current UTC time (including milliseconds)
-    current_time = datetime.utcnow()
-    object_key = f"image_{current_time.strftime('%Y%m%d%H%M%S%f')}.png"
+    # Upload the image; content-hash keys make re-seeding the same image a no-op
+    try:
+        ingest_image_from_url(initial_image_url, bucket_name, test_user)
+    except requests.RequestException as e:
+        logger.error("Failed to download the image", extra={'url': initial_image_url, 'error': str(e)})
+    except NoCredentialsError:
+        logger.error("Credentials not available, unable to upload the image to S3")
+    except Exception as e:
+        logger.error("Error uploading image to S3", extra={'error': str(e)})
 
-    # Check if the object (image) already exists in the S3 bucket
-    if not does_object_exist(bucket_name, object_key):
-        try:
-            response = requests.get(initial_image_url)
-            if response.status_code == 200:
-                s3.put_object(Body=response.content, Bucket=bucket_name, Key=object_key)
-                print(f"Image uploaded to S3 bucket '{bucket_name}' with key '{object_key}'.")
-
-                # Get the URL of the uploaded image
-                s3_url = f"https://{bucket_name}.s3.amazonaws.com/{object_key}"
-
-                # Add the approved vehicle image using the obtained URL
-                add_approved_vehicle_image(test_user, object_key, s3_url)
-            else:
-                print(f"Failed to download the image from {initial_image_url}. Status code: {response.status_code}")
-        except NoCredentialsError:
-            print("Credentials not available. Unable to upload the image to S3.")
-        except Exception as e:
-            print(f"Error uploading image to S3: {e}")
-
-def list_objects_in_bucket(bucket_name):
-    # Create an S3 client
-    s3 = boto3.client('s3')
-
-    # List objects in the S3 bucket
+def create_listing_cache():
+    if listing_cache_backend == 'sqlite':
+        return SQLiteListingCache(listing_cache_path, listing_cache_ttl, listing_cache_stale_ttl, listing_cache_max_entries, listing_cache_refresh_workers)
+    return ListingCache(listing_cache_ttl, listing_cache_stale_ttl, listing_cache_max_entries, listing_cache_refresh_workers)
+
+listing_cache = create_listing_cache()
+
+job_queue = JobQueue(job_queue_path, job_max_attempts, job_retry_delay, job_timeout)
+
+# Job generation this process last invalidated its listing cache for
+_seen_job_generation = None
+
+def sync_listing_cache_with_jobs():
+    # Uploads are recorded by the job consumer, whose own cache invalidation
+    # never reaches a web worker's memory cache. Drop this worker's cached pages
+    # whenever a job has finished since the last check. The sqlite backend is
+    # shared and already invalidated by the consumer.
+    global _seen_job_generation
+    if listing_cache.backend != 'memory':
+        return
     try:
-        response = s3.list_objects(Bucket=bucket_name)
-        objects = response.get('Contents', [])
+        generation = job_queue.generation()
+    except Exception as e:
+        logger.error("Error reading the job generation", extra={'error': str(e)})
+        return
+    if generation != _seen_job_generation:
+        if _seen_job_generation is not None:
+            listing_cache.invalidate()
+        _seen_job_generation = generation
+
+def encode_page_token(last_evaluated_key):
+    # Turn a DynamoDB LastEvaluatedKey into an opaque, URL-safe page token
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode()).decode()
+
+def decode_page_token(page_token):
+    # Inverse of encode_page_token, raising ValueError for anything malformed
+    if not page_token:
+        return None
+    last_evaluated_key = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+    if not isinstance(last_evaluated_key, dict) or not all(isinstance(value, str) for value in last_evaluated_key.values()):
+        raise ValueError("Invalid page token")
+    return last_evaluated_key
+
+def fetch_approved_images_page(page_size, page_token):
+    # Read one page of the gallery, newest first, from the gallery index,
+    # raising on any error
+    table = get_resource('dynamodb').Table(approved_images_table_name)
 
-        # Ensure 'image_id' and 'image_filename' are present for each object
-        for obj in objects:
-            obj['image_id'] = obj.get('image_id', '')  # Set a default value if it doesn't exist
-            obj['image_filename'] = obj.get('image_filename', '')  # Set a default value if it doesn't exist
+    query = {
+        'IndexName': gallery_index_name,
+        'KeyConditionExpression': Key('gallery').eq(gallery_partition),
+        'ScanIndexForward': False,
+        'Limit': page_size,
+        'ProjectionExpression': ', '.join(f"#{name}" for name in gallery_attributes),
+        'ExpressionAttributeNames': {f"#{name}": name for name in gallery_attributes}
+    }
+    exclusive_start_key = decode_page_token(page_token)
+    if exclusive_start_key:
+        query['ExclusiveStartKey'] = exclusive_start_key
 
-        return objects
+    response = table.query(**query)
+    return response.get('Items', []), encode_page_token(response.get('LastEvaluatedKey'))
+
+def list_approved_images(page_size=gallery_page_size, page_token=None):
+    # List one page of approved images, returning the items and the token for
+    # the next page (None on the last page). Pages are served from the listing
+    # cache; failed queries are never cached.
+    sync_listing_cache_with_jobs()
+    try:
+        return listing_cache.get(
+            (approved_images_table_name, page_size, page_token),
+            lambda: fetch_approved_images_page(page_size, page_token)
+        )
+    except ValueError:
+        # The page token could not be decoded, let the caller reject it
+        raise
     except Exception as e:
-        print(f"Error listing objects in S3 bucket: {e}")
-        return []
+        logger.error("Error listing approved images", extra={'error': str(e)})
+        return [], None
+
+def iter_approved_images(page_size, page_token, page):
+    # Lazily yield one page of approved images, querying the gallery index a
+    # chunk at a time. page['next_page_token'] is only known, and set, once the
+    # generator is exhausted. Streamed pages bypass the listing cache.
+    remaining = page_size
+    try:
+        while remaining:
+            items, page_token = fetch_approved_images_page(min(remaining, gallery_stream_chunk_size), page_token)
+            yield from items
+            remaining -= len(items)
+            if not page_token:
+                break
+    except Exception as e:
+        # The response has already started, end the page early instead
+        logger.error("Error streaming approved images", extra={'error': str(e)})
+        page_token = None
+    page['next_page_token'] = page_token
+
+def gallery_image(item):
+    # Everything the template needs to render one gallery image: the full
+    # size URL, the URL to display and a srcset of the resized variants
+    full_url = image_url_for_key(item['image_filename'])
+    image = dict(item, full_url=full_url, display_url=full_url, srcset='')
+    variants = item.get('variants')
+    if variants:
+        sources = sorted(variants.values(), key=lambda variant: int(variant['width']))
+        image['srcset'] = ', '.join(
+            f"{image_url_for_key(variant['key'])} {int(variant['width'])}w"
+            for variant in sources
+        )
+        # Browsers without srcset support get the medium (or smallest) variant
+        display = variants.get('medium') or sources[0]
+        image['display_url'] = image_url_for_key(display['key'])
+    return image
+
+if compression_enabled:
+    # Wrapping wsgi_app keeps app itself a Flask object for wsgi.py and the CLI
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, compression_min_size, gzip_level, brotli_quality)
+
+before_render_template.connect(start_render_timer, app)
+template_rendered.connect(stop_render_timer, app)
+app.wsgi_app = TimingMiddleware(app.wsgi_app, metrics, server_timing_enabled)
+
+def get_page_args():
+    # Read and validate the paging query parameters for the gallery
+    page_token = request.args.get('page_token') or None
+    try:
+        page_size = int(request.args.get('page_size', gallery_page_size))
+    except ValueError:
+        abort(400, "page_size must be an integer")
+    if not 1 <= page_size <= gallery_max_page_size:
+        abort(400, f"page_size must be between 1 and {gallery_max_page_size}")
+    return page_size, page_token
+
+def gallery_validators(items, page_size, next_page_token):
+    # Weak ETag and Last-Modified for one gallery page. Presigned URLs change
+    # with the signing window, so the window is part of both validators.
+    state = [items, page_size, next_page_token]
+    last_modified = max(
+        (datetime.fromisoformat(item['uploaded_at']) for item in items if item.get('uploaded_at')),
+        default=None
+    )
+    if presign_image_urls:
+        window = current_presign_window()
+        state.append(window)
+        window_start = datetime.utcfromtimestamp(window * presign_window)
+        last_modified = max(last_modified or window_start, window_start)
+    etag = hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+    if last_modified:
+        # HTTP dates have one second precision
+        last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, last_modified
+
+def gallery_cache_control():
+    # Let browsers and a fronting CDN reuse a page, but never past the end of
+    # the signing window its presigned URLs were generated in
+    max_age = gallery_cache_max_age
+    if presign_image_urls:
+        window_end = (current_presign_window() + 1) * presign_window
+        max_age = min(max_age, max(int(window_end - time.time()), 0))
+    return f"public, max-age={max_age}, stale-while-revalidate={gallery_cache_stale_while_revalidate}"
+
+def set_gallery_cache_headers(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = gallery_cache_control()
+    return response
+
+def buffer_chunks(chunks, size=gallery_stream_buffer_size):
+    # Join the many small strings a streamed template yields into pieces of
+    # at least size bytes, so each write (and compression flush) is worthwhile
+    buffer, buffered = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def stream_index(page_size, page_token):
+    # Render a large gallery page while it is being listed. There is no ETag
+    # because the page's content is only known once it has been sent.
+    try:
+        decode_page_token(page_token)
+    except ValueError:
+        abort(400, "Invalid page_token")
+
+    page = {'next_page_token': None}
+    images = (gallery_image(item) for item in iter_approved_images(page_size, page_token, page))
+    response = app.response_class(
+        buffer_chunks(stream_template("index.html", uploaded_images=images, page_size=page_size, page=page)),
+        mimetype='text/html'
+    )
+    response.headers['Cache-Control'] = gallery_cache_control()
+    return response
 
 @app.route("/")
 def index():
-    # List all objects in the S3 bucket
-    objects = list_objects_in_bucket("approved-vehicle-images-3632442")
+    page_size, page_token = get_page_args()
+    if page_size >= gallery_stream_threshold:
+        return stream_index(page_size, page_token)
+
+    # List one page of approved images from DynamoDB
+    try:
+        items, next_page_token = list_approved_images(page_size, page_token)
+    except ValueError:
+        abort(400, "Invalid page_token")
+
+    # Answer repeat views with 304 before building URLs or rendering anything
+    etag, last_modified = gallery_validators(items, page_size, next_page_token)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return set_gallery_cache_headers(app.response_class(status=304), etag, last_modified)
 
-    # Generate full URLs for each image
-    base_url = f"https://approved-vehicle-images-3632442.s3.amazonaws.com/"
-    for obj in objects:
-        obj['full_url'] = f"{base_url}{obj['Key']}"
-        print(f"Image ID: {obj['image_id']}, Filename: {obj['image_filename']}, URL: {obj['full_url']}")
+    # Generate full URLs for each image, leaving the cached listing untouched
+    images = [gallery_image(item) for item in items]
+    logger.debug("Rendering gallery page", extra={'images': len(images), 'page_size': page_size})
 
     # Render the HTML template and pass variables to it
-    return render_template("index.html", uploaded_images=objects)
+    response = app.make_response(render_template(
+        "index.html",
+        uploaded_images=images,
+        page_size=page_size,
+        page={'next_page_token': next_page_token}
+    ))
+    return set_gallery_cache_headers(response, etag, last_modified)
+
+def collect_app_metrics():
+    # Samples read from the app's own counters when /metrics is scraped
+    cache = listing_cache.stats()
+    writer = metadata_writer.stats()
+    presign = presigned_image_url.cache_info()
+    backend = (('backend', cache['backend']),)
+    return [
+        ('listing_cache_requests_total', 'counter', "Gallery listing cache lookups by result.",
+            [(backend + (('result', result),), cache[result]) for result in ('hits', 'stale_hits', 'misses')]),
+        ('listing_cache_events_total', 'counter', "Gallery listing cache refreshes, refresh errors, evictions and invalidations.",
+            [(backend + (('event', event),), cache[event]) for event in ('refreshes', 'refresh_errors', 'evictions', 'invalidations')]),
+        ('listing_cache_entries', 'gauge', "Pages held by the gallery listing cache.", [(backend, cache['entries'])]),
+        ('metadata_writer_items_total', 'counter', "Metadata items written or given up on.",
+            [((('result', 'written'),), writer['written']), ((('result', 'failed'),), writer['failed'])]),
+        ('metadata_writer_batches_total', 'counter', "BatchWriteItem calls made by the metadata writer.", [((), writer['batches'])]),
+        ('metadata_writer_retries_total', 'counter', "Retried metadata batches.", [((), writer['retries'])]),
+        ('metadata_writer_pending', 'gauge', "Metadata items waiting for the next batch.", [((), writer['pending'])]),
+        ('presign_cache_requests_total', 'counter', "Presigned URL cache lookups by result.",
+            [((('result', 'hit'),), presign.hits), ((('result', 'miss'),), presign.misses)]),
+        ('log_records_dropped_total', 'counter', "Log records dropped because the log queue was full.", [((), log_handler.dropped)])
+    ]
+
+metrics.add_collector(collect_app_metrics)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape endpoint; every worker process reports its own numbers
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/cache-stats")
+def cache_stats():
+    # Hit/miss counters for sizing the listing cache
+    return jsonify(listing_cache.stats())
+
+def get_image_extension(filename, content_type):
+    # Validate an uploaded file name and content type, returning the extension
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in allowed_image_extensions or not (content_type or '').startswith('image/'):
+        abort(400, "Only image files can be uploaded")
+    return extension
 
 @app.route("/upload", methods=["POST"])
 def upload():
-    # Handle the file upload logic here
-    # You can access the uploaded file using request.files['file']
-    # Implement the logic to upload the file to S3 and update the HTML accordingly
+    # werkzeug spools large form files to a temporary file, which is copied in
+    # chunks to the upload spool directory. Hashing, storing in S3, resizing
+    # and the metadata write all happen later in a job worker.
+    uploaded_file = request.files.get('file')
+    if uploaded_file is None or not uploaded_file.filename:
+        abort(400, "No file was uploaded")
+
+    extension = get_image_extension(uploaded_file.filename, uploaded_file.mimetype)
+
+    image_id = str(uuid.uuid4())
+    make_private_dir(upload_spool_dir)
+    spool_path = os.path.join(upload_spool_dir, f"{image_id}{extension}")
+    uploaded_file.save(spool_path)
+    job_queue.enqueue(image_id, 'store_upload', {
+        'path': spool_path,
+        'username': test_user,
+        'extension': extension,
+        'content_type': uploaded_file.mimetype
+    })
 
-    return "Upload action will be implemented here"
+    return upload_accepted(image_id)
+
+def upload_accepted(image_id):
+    # Scripts get the job status URL, the plain form goes back to the gallery
+    status_url = url_for('upload_status', image_id=image_id)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(image_id=image_id, status_url=status_url), 202
+    return redirect(url_for('index'), code=303)
+
+@app.route("/upload/status/<image_id>")
+def upload_status(image_id):
+    # Processing status of an upload queued by /upload or /upload/complete
+    status = job_queue.status(image_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+@app.route("/upload/presign", methods=["POST"])
+def upload_presign():
+    # Issue a presigned POST policy so the browser uploads the image straight
+    # to S3 without the bytes passing through this worker
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    content_type = data.get('content_type', '')
+    extension = get_image_extension(filename, content_type)
+    object_key = direct_upload_prefix + new_image_key(extension)
+
+    s3 = get_client('s3')
+    try:
+        presigned_post = s3.generate_presigned_post(
+            Bucket=approved_images_bucket_name,
+            Key=object_key,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, upload_max_bytes]
+            ],
+            ExpiresIn=presigned_post_expiry
+        )
+    except Exception as e:
+        logger.error("Error creating presigned POST", extra={'error': str(e)})
+        abort(502, "Could not prepare the upload")
+
+    return jsonify(key=object_key, url=presigned_post['url'], fields=presigned_post['fields'])
+
+@app.route("/upload/complete", methods=["POST"])
+def upload_complete():
+    # Called by the browser once its direct upload to S3 has finished
+    data = request.get_json(silent=True) or {}
+    object_key = data.get('key', '')
+    if not object_key.startswith(direct_upload_prefix) or os.path.splitext(object_key)[1].lower() not in allowed_image_extensions:
+        abort(400, "Unknown upload")
+
+    # Only record images that really made it into the bucket
+    if not does_object_exist(approved_images_bucket_name, object_key):
+        abort(400, "The upload has not reached S3")
+
+    # Resizing and the metadata write happen in a job worker
+    image_id = str(uuid.uuid4())
+    job_queue.enqueue(image_id, 'register_direct_upload', {
+        'object_key': object_key,
+        'username': test_user
+    })
+
+    status_url = url_for('upload_status', image_id=image_id)
+    return jsonify(key=object_key, image_id=image_id, status_url=status_url), 202
 
 def create_vehicle_id_table(table_name):
-    # Create a DynamoDB client
-    dynamodb = boto3.client('dynamodb')
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
 
     # Table doesn't exist, create it
     try:
@@ -197,22 +1238,90 @@ def create_vehicle_id_table(table_name):
                 {
                     'AttributeName': 'username',
                     'AttributeType': 'S'  # Assuming 'S' for string, adjust as needed
+                },
+                {
+                    'AttributeName': 'gallery',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'uploaded_at',
+                    'AttributeType': 'S'
                 }
                 # Add more attribute definitions if needed
             ],
+            GlobalSecondaryIndexes=[gallery_index_definition()],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 5,  # Adjust based on your needs
                 'WriteCapacityUnits': 5  # Adjust based on your needs
             }
         )
-        print(f"DynamoDB table '{table_name}' created successfully. Status: {response['TableDescription']['TableStatus']}")
+        logger.info("DynamoDB table created", extra={'table': table_name, 'status': response['TableDescription']['TableStatus']})
     except Exception as e:
-        print(f"Error creating DynamoDB table: {e}")
+        logger.error("Error creating DynamoDB table", extra={'table': table_name, 'error': str(e)})
+
+def gallery_index_definition():
+    return {
+        'IndexName': gallery_index_name,
+        'KeySchema': [
+            {
+                'AttributeName': 'gallery',
+                'KeyType': 'HASH'  # Partition key
+            },
+            {
+                'AttributeName': 'uploaded_at',
+                'KeyType': 'RANGE'  # Sort key, newest images are read first
+            }
+        ],
+        # Queries project only the rendered attributes, the index keeps them
+        # all so new gallery fields never require rebuilding it
+        'Projection': {
+            'ProjectionType': 'ALL'
+        },
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,  # Adjust based on your needs
+            'WriteCapacityUnits': 5  # Adjust based on your needs
+        }
+    }
+
+def does_gallery_index_exist(table_name):
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
+
+    response = dynamodb.describe_table(TableName=table_name)
+    indexes = response['Table'].get('GlobalSecondaryIndexes', [])
+    return any(index['IndexName'] == gallery_index_name for index in indexes)
+
+def create_gallery_index(table_name):
+    # Add the gallery index to a table created before it existed
+    dynamodb = get_client('dynamodb')
+
+    try:
+        dynamodb.update_table(
+            TableName=table_name,
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'gallery',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'uploaded_at',
+                    'AttributeType': 'S'
+                }
+            ],
+            GlobalSecondaryIndexUpdates=[
+                {
+                    'Create': gallery_index_definition()
+                }
+            ]
+        )
+        logger.info("Gallery index is being created", extra={'index': gallery_index_name, 'table': table_name})
+    except Exception as e:
+        logger.error("Error creating gallery index", extra={'index': gallery_index_name, 'error': str(e)})
 
 
 def create_login_credentials_table(table_name):
-    # Create a DynamoDB client
-    dynamodb = boto3.client('dynamodb')
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
 
     # Table doesn't exist, create it
     try:
@@ -237,84 +1346,246 @@ def create_login_credentials_table(table_name):
                 'WriteCapacityUnits': 5  # Adjust based on your needs
             }
         )
-        print(f"DynamoDB table '{table_name}' created successfully. Status: {response['TableDescription']['TableStatus']}")
+        logger.info("DynamoDB table created", extra={'table': table_name, 'status': response['TableDescription']['TableStatus']})
     except Exception as e:
-        print(f"Error creating DynamoDB table: {e}")
+        logger.error("Error creating DynamoDB table", extra={'table': table_name, 'error': str(e)})
+
+def create_image_hashes_table(table_name):
+    # Get the shared DynamoDB client
+    dynamodb = get_client('dynamodb')
+
+    # Maps the SHA-256 of each stored image to its image_id
+    try:
+        response = dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'content_hash',
+                    'KeyType': 'HASH'  # Partition key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'content_hash',
+                    'AttributeType': 'S'
+                }
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 5,  # Adjust based on your needs
+                'WriteCapacityUnits': 5  # Adjust based on your needs
+            }
+        )
+        logger.info("DynamoDB table created", extra={'table': table_name, 'status': response['TableDescription']['TableStatus']})
+    except Exception as e:
+        logger.error("Error creating DynamoDB table", extra={'table': table_name, 'error': str(e)})
 
 def hash_password(password):
     # Use a secure hash function (e.g., SHA-256) to hash the password
     return hashlib.sha256(password.encode()).hexdigest()
 
 def insert_login_credentials(username, password):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('login-credentials')
-
     # Hash the password before storing it
     hashed_password = hash_password(password)
 
-    # Insert the item into the table
-    try:
-        response = table.put_item(
-            Item={
-                'username': username,
-                'password': hashed_password
-            }
-        )
-        print(f"Item added to 'login-credentials' table: {response}")
-    except Exception as e:
-        print(f"Error inserting item into 'login-credentials' table: {e}")
+    # Queue the item for the next batch write to the table
+    metadata_writer.put('login-credentials', {
+        'username': username,
+        'password': hashed_password
+    })
+    logger.debug("Item queued", extra={'table': login_credentials_table_name, 'username': username})
 
 
 def delete_dynamodb_table(table_name):
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = get_client('dynamodb')
 
     try:
         dynamodb.delete_table(TableName=table_name)
-        print(f"DynamoDB table '{table_name}' deleted successfully.")
+        logger.info("DynamoDB table deleted", extra={'table': table_name})
     except Exception as e:
-        print(f"Error deleting DynamoDB table: {e}")
+        logger.error("Error deleting DynamoDB table", extra={'table': table_name, 'error': str(e)})
+
+def iter_object_versions(bucket_name):
+    # Yield every object version and delete marker in the bucket. Unversioned
+    # buckets report each key once with the version 'null'.
+    s3 = get_client('s3')
+
+    paginator = s3.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket_name, PaginationConfig={'PageSize': delete_batch_size}):
+        for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            yield {'Key': version['Key'], 'VersionId': version['VersionId']}
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def delete_object_batch(bucket_name, batch):
+    # Delete up to 1000 object versions in one request, returning how many
+    # were deleted and how many failed
+    s3 = get_client('s3')
+
+    response = s3.delete_objects(Bucket=bucket_name, Delete={'Objects': batch, 'Quiet': True})
+    errors = response.get('Errors', [])
+    for error in errors:
+        logger.error("Error deleting object from S3 bucket", extra={'key': error['Key'], 'code': error['Code'], 'error': error['Message']})
+    return len(batch) - len(errors), len(errors)
 
 def delete_s3_bucket(bucket_name):
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     try:
-        # List all objects in the bucket
-        response = s3.list_objects(Bucket=bucket_name)
-        objects = response.get('Contents', [])
+        deleted = 0
+        failed = 0
+        started = time.monotonic()
+
+        def record(done):
+            nonlocal deleted, failed
+            for future in done:
+                batch_deleted, batch_failed = future.result()
+                deleted += batch_deleted
+                failed += batch_failed
+            elapsed = time.monotonic() - started
+            logger.info("Deleting objects", extra={'bucket': bucket_name, 'deleted': deleted, 'objects_per_second': round(deleted / max(elapsed, 0.001))})
 
-        # Delete all objects in the bucket
-        for obj in objects:
-            s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
+        # Delete every version of every object in parallel batches, keeping only
+        # a bounded number of batches in flight ahead of the listing
+        with ThreadPoolExecutor(max_workers=delete_max_workers) as executor:
+            pending = set()
+            for batch in iter_batches(iter_object_versions(bucket_name), delete_batch_size):
+                pending.add(executor.submit(delete_object_batch, bucket_name, batch))
+                if len(pending) >= delete_max_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    record(done)
+            if pending:
+                record(wait(pending).done)
+
+        if failed:
+            logger.error("Objects could not be deleted, keeping S3 bucket", extra={'bucket': bucket_name, 'failed': failed})
+            return
 
         # Delete the bucket itself
         s3.delete_bucket(Bucket=bucket_name)
-        print(f"S3 bucket '{bucket_name}' and its contents deleted successfully.")
+        elapsed = time.monotonic() - started
+        logger.info("S3 bucket and its objects deleted", extra={'bucket': bucket_name, 'deleted': deleted, 'seconds': round(elapsed, 1)})
     except NoCredentialsError:
-        print("Credentials not available. Unable to delete S3 bucket.")
+        logger.error("Credentials not available, unable to delete S3 bucket")
     except Exception as e:
-        print(f"Error deleting S3 bucket: {e}")
+        logger.error("Error deleting S3 bucket", extra={'bucket': bucket_name, 'error': str(e)})
+
+def wait_for_gallery_index(table_name):
+    # Block until a newly added gallery index has finished backfilling; there
+    # is no botocore waiter for index status
+    dynamodb = get_client('dynamodb')
+
+    for attempt in range(provision_waiter_max_attempts):
+        response = dynamodb.describe_table(TableName=table_name)
+        indexes = response['Table'].get('GlobalSecondaryIndexes', [])
+        if any(index['IndexName'] == gallery_index_name and index['IndexStatus'] == 'ACTIVE' for index in indexes):
+            logger.info("Gallery index is active", extra={'index': gallery_index_name})
+            return
+        time.sleep(provision_waiter_delay)
+    raise TimeoutError(f"Gallery index '{gallery_index_name}' did not become active")
+
+def legacy_upload_time(image_filename):
+    # Keys from before content hashing embed their upload time, e.g.
+    # image_20231101120000123456.png; other keys carry no time at all
+    match = re.match(r'image_(\d{20})', image_filename)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(1), '%Y%m%d%H%M%S%f').isoformat()
+    except ValueError:
+        return None
+
+def backfill_gallery_attributes(table_name):
+    # Items written before the gallery index existed lack its key attributes
+    # and are invisible to the gallery; give them a partition and an upload
+    # time (from the key when it has one, otherwise now). Safe to re-run.
+    table = get_resource('dynamodb').Table(table_name)
+    scan = {
+        'FilterExpression': Attr('gallery').not_exists(),
+        'ProjectionExpression': 'image_filename, username, uploaded_at'
+    }
+    backfilled = 0
+    while True:
+        response = table.scan(**scan)
+        for item in response.get('Items', []):
+            uploaded_at = item.get('uploaded_at') or legacy_upload_time(item['image_filename']) or datetime.utcnow().isoformat()
+            table.update_item(
+                Key={'image_filename': item['image_filename'], 'username': item['username']},
+                UpdateExpression='SET gallery = :gallery, uploaded_at = if_not_exists(uploaded_at, :uploaded_at)',
+                ConditionExpression='attribute_exists(image_filename)',
+                ExpressionAttributeValues={':gallery': gallery_partition, ':uploaded_at': uploaded_at}
+            )
+            backfilled += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    if backfilled:
+        logger.info("Backfilled gallery attributes", extra={'table': table_name, 'items': backfilled})
+
+def run_concurrently(steps):
+    # Run every step on its own thread and re-raise the first failure once
+    # they have all finished
+    if not steps:
+        return
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = [executor.submit(step) for step in steps]
+    for future in futures:
+        future.result()
+
 def create_resources():
-    # Check if the table exists before calling the function
+    # Check the current state once before creating anything
+    create_steps = []
+    wait_steps = []
+    seed_steps = []
+
     if not does_table_exist(approved_images_table_name):
-        create_vehicle_id_table(approved_images_table_name)
+        create_steps.append(partial(create_vehicle_id_table, approved_images_table_name))
+        wait_steps.append(partial(wait_for_table_creation, approved_images_table_name))
+    else:
+        if not does_gallery_index_exist(approved_images_table_name):
+            create_steps.append(partial(create_gallery_index, approved_images_table_name))
+            wait_steps.append(partial(wait_for_gallery_index, approved_images_table_name))
+        # Also covers tables that got the index from an earlier provision
+        seed_steps.append(partial(backfill_gallery_attributes, approved_images_table_name))
+
+    if not does_table_exist(image_hashes_table_name):
+        create_steps.append(partial(create_image_hashes_table, image_hashes_table_name))
+        wait_steps.append(partial(wait_for_table_creation, image_hashes_table_name))
 
-    # Check if the bucket exists before calling the function
     if not does_bucket_exist(approved_images_bucket_name):
-        create_s3_bucket_and_upload_image(approved_images_bucket_name, initial_image_url, test_user)
+        create_steps.append(partial(create_s3_bucket, approved_images_bucket_name))
+        wait_steps.append(partial(wait_for_bucket_creation, approved_images_bucket_name))
+        seed_steps.append(partial(create_s3_bucket_and_upload_image, approved_images_bucket_name, initial_image_url, test_user))
+    elif not does_bucket_cors_exist(approved_images_bucket_name):
+        create_steps.append(partial(configure_bucket_cors, approved_images_bucket_name))
 
-    # Check if the table exists before calling the function
     if not does_table_exist(login_credentials_table_name):
-        create_login_credentials_table(login_credentials_table_name)
-        # Wait for the table to become active before proceeding
-        wait_for_table_creation(login_credentials_table_name)
-        
-        # Call the function to insert a new username and password into the 'login-credentials' table
-        insert_login_credentials(test_user, test_password)
+        create_steps.append(partial(create_login_credentials_table, login_credentials_table_name))
+        wait_steps.append(partial(wait_for_table_creation, login_credentials_table_name))
+        # Insert the test username and password into the 'login-credentials' table
+        seed_steps.append(partial(insert_login_credentials, test_user, test_password))
+
+    if not create_steps:
+        logger.info("All resources already exist, nothing to create")
+
+    # Start every missing resource at once, wait for all of them, and only
+    # then seed data so no write races a table that is still being created
+    run_concurrently(create_steps)
+    run_concurrently(wait_steps)
+    run_concurrently(seed_steps)
+    metadata_writer.flush()
 
 def delete_resources():
     # Set the names of the resources to be deleted
     approved_vehicle_images_bucket_name = "approved-vehicle-images-3632442"
-    dynamodb_table_names = ["approved-vehicles", "login-credentials"]
+    dynamodb_table_names = ["approved-vehicles", "login-credentials", "image-hashes"]
 
     # Delete the S3 bucket
     delete_s3_bucket(approved_vehicle_images_bucket_name)
@@ -323,8 +1594,294 @@ def delete_resources():
     for table_name in dynamodb_table_names:
         delete_dynamodb_table(table_name)
 
-delete_resources()
-create_resources()
+def read_manifest(manifest_path):
+    # Yield {'source': ..., 'username': ...} entries from a CSV file with a
+    # 'source' column, or from a JSONL file with one object per line
+    with open(manifest_path, newline='') as manifest:
+        if manifest_path.endswith('.csv'):
+            rows = csv.DictReader(manifest)
+        else:
+            rows = (json.loads(line) for line in manifest if line.strip())
+        for row in rows:
+            yield {'source': row['source'], 'username': row.get('username') or test_user}
+
+def read_checkpoint(checkpoint_path):
+    # Sources that were fully imported by an earlier run
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as checkpoint:
+        return {line.rstrip('\n') for line in checkpoint if line.strip()}
+
+@contextmanager
+def open_image_source(source):
+    # Open a manifest source, either a URL or a local path, yielding a
+    # readable stream and its content type
+    if source.startswith(('http://', 'https://')):
+        with open_image_url(source) as (stream, content_type):
+            yield stream, content_type
+    else:
+        with open(source, 'rb') as image_file:
+            yield image_file, mimetypes.guess_type(source)[0] or 'application/octet-stream'
+
+def import_manifest_entry(transfer_manager, entry):
+    # Upload one manifest entry to the bucket and return its content hash and
+    # approved-vehicles item, which the caller writes in batches before
+    # completing the hash claim, or None for a duplicate image. Incomplete
+    # claims are finished as in store_image, so resuming after a crash
+    # rewrites the entries whose metadata was never flushed.
+    source = entry['source']
+    extension = os.path.splitext(urlparse(source).path)[1].lower()
+    if extension not in allowed_image_extensions:
+        raise ValueError(f"Unsupported image type: {source}")
+
+    with open_image_source(source) as (stream, content_type), hashed_image(stream) as (fileobj, content_hash):
+        object_key = image_key_for_hash(content_hash, extension)
+        image_id = str(uuid.uuid4())
+        username = entry['username']
+        existing = claim_image_hash(content_hash, image_id, object_key, username)
+        if existing is not None:
+            if is_complete_claim(existing):
+                logger.info("Skipping image that is already stored", extra={'source': source})
+                return None
+            image_id, object_key = existing['image_id'], existing['image_filename']
+            username = existing.get('username', username)
+
+        try:
+            future = transfer_manager.upload(
+                fileobj,
+                approved_images_bucket_name,
+                object_key,
+                extra_args={'ContentType': content_type}
+            )
+            future.result()
+        except Exception:
+            if existing is None:
+                release_image_hash(content_hash, image_id)
+            raise
+
+        variants = generate_image_variants(fileobj, object_key)
+
+    image_url = s3_object_url(approved_images_bucket_name, object_key)
+    return content_hash, build_approved_vehicle_item(username, object_key, image_url, image_id, variants)
+
+def import_images(manifest_path, checkpoint_path, max_workers=import_max_workers):
+    # Bulk-load the images listed in a manifest. Downloads run on a bounded
+    # thread pool, uploads share one s3transfer TransferManager and metadata
+    # goes out in 25-item BatchWriteItem requests. Entries are checkpointed
+    # in chunks once their metadata has been flushed, so an interrupted
+    # import resumes where it stopped.
+    completed = read_checkpoint(checkpoint_path)
+    entries = (entry for entry in read_manifest(manifest_path) if entry['source'] not in completed)
+    table = get_resource('dynamodb').Table(approved_images_table_name)
+    config = TransferConfig(
+        multipart_threshold=transfer_config.multipart_threshold,
+        multipart_chunksize=transfer_config.multipart_chunksize,
+        max_concurrency=max(max_workers, transfer_config.max_concurrency)
+    )
+
+    imported = 0
+    failed = 0
+    started = time.monotonic()
+    with create_transfer_manager(get_client('s3'), config) as transfer_manager, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open(checkpoint_path, 'a') as checkpoint:
+        for chunk in iter_batches(entries, import_checkpoint_every):
+            futures = {executor.submit(import_manifest_entry, transfer_manager, entry): entry for entry in chunk}
+            done_sources = []
+            written = []
+
+            # Leaving the batch writer flushes every buffered item
+            with table.batch_writer(overwrite_by_pkeys=['image_filename', 'username']) as batch:
+                for future in wait(futures).done:
+                    entry = futures[future]
+                    try:
+                        imported_entry = future.result()
+                        if imported_entry is not None:
+                            batch.put_item(Item=imported_entry[1])
+                            written.append(imported_entry)
+                        done_sources.append(entry['source'])
+                    except Exception as e:
+                        failed += 1
+                        logger.error("Error importing image", extra={'source': entry['source'], 'error': str(e)})
+
+            # Only now that the items are stored do their claims count as
+            # duplicates
+            list(executor.map(lambda imported_entry: complete_image_hash(imported_entry[0], imported_entry[1]['image_id']), written))
+
+            for source in done_sources:
+                checkpoint.write(source + '\n')
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+            imported += len(done_sources)
+            elapsed = time.monotonic() - started
+            logger.info("Importing images", extra={'imported': imported, 'failed': failed, 'items_per_second': round(imported / max(elapsed, 0.001), 1)})
+
+    if imported:
+        listing_cache.invalidate()
+    return imported, failed
+
+def process_store_upload(image_id, payload):
+    # Store a file spooled by /upload: dedupe, upload, resize and record it
+    with open(payload['path'], 'rb') as image_file:
+        return store_image(image_file, payload['username'], payload['extension'], payload['content_type'], image_id=image_id)
+
+def delete_direct_upload(object_key):
+    # The image is stored under another key, so the browser's copy goes
+    try:
+        get_client('s3').delete_object(Bucket=approved_images_bucket_name, Key=object_key)
+    except Exception as e:
+        logger.error("Error deleting duplicate upload", extra={'key': object_key, 'error': str(e)})
+
+def finish_direct_upload(content_hash, image_id, duplicate_key):
+    complete_image_hash(content_hash, image_id)
+    if duplicate_key is not None:
+        delete_direct_upload(duplicate_key)
+
+def process_register_direct_upload(image_id, payload):
+    # Deduplicate, resize and record an image the browser uploaded straight
+    # to S3. Claims are resolved like in store_image: a complete claim returns
+    # the image already stored and the browser's object is deleted, and an
+    # incomplete one is finished under its own image_id, username and key
+    # (copying the image there, and deleting the browser's object only once
+    # the item is written, so a retry can still read it).
+    uploaded_key = object_key = payload['object_key']
+    username = payload['username']
+    requested_image_id = image_id
+    s3 = get_client('s3')
+    with tempfile.SpooledTemporaryFile(max_size=hash_spool_max_memory) as downloaded:
+        s3.download_fileobj(approved_images_bucket_name, object_key, downloaded, Config=transfer_config)
+        downloaded.seek(0)
+        with hashed_image(downloaded) as (image_file, content_hash):
+            existing = claim_image_hash(content_hash, image_id, object_key, username)
+            if existing is not None:
+                if is_complete_claim(existing) and existing.get('image_id') != image_id:
+                    logger.info("Duplicate image already stored", extra={'content_hash': content_hash, 'image_filename': existing.get('image_filename')})
+                    if existing.get('image_filename') != uploaded_key:
+                        delete_direct_upload(uploaded_key)
+                    return {
+                        'image_id': existing.get('image_id'),
+                        'image_filename': existing.get('image_filename'),
+                        'image_url': s3_object_url(approved_images_bucket_name, existing.get('image_filename')),
+                        'duplicate': True
+                    }
+                image_id, object_key = existing['image_id'], existing['image_filename']
+                username = existing.get('username', username)
+                if object_key != uploaded_key:
+                    s3.copy({'Bucket': approved_images_bucket_name, 'Key': uploaded_key}, approved_images_bucket_name, object_key, Config=transfer_config)
+            variants = generate_image_variants(image_file, object_key)
+
+    image_url = s3_object_url(approved_images_bucket_name, object_key)
+    add_approved_vehicle_image(
+        username, object_key, image_url, image_id, variants,
+        on_written=partial(finish_direct_upload, content_hash, image_id, uploaded_key if object_key != uploaded_key else None)
+    )
+    return {'image_id': image_id, 'image_filename': object_key, 'image_url': image_url, 'duplicate': image_id != requested_image_id}
+
+job_handlers = {
+    'store_upload': process_store_upload,
+    'register_direct_upload': process_register_direct_upload
+}
+
+def process_job(job):
+    # Runs in a worker process. Metadata is flushed before returning so a job
+    # is only marked done once its item is in DynamoDB. Both handlers are safe
+    # to run again: both finish incomplete hash claims under the claim's own
+    # image_id, so a retry rewrites the same item and variants.
+    failed_before = metadata_writer.stats()['failed']
+    result = job_handlers[job['kind']](job['image_id'], job['payload'])
+    metadata_writer.flush()
+    if metadata_writer.stats()['failed'] > failed_before:
+        raise RuntimeError("Metadata could not be written")
+    return result
+
+def cleanup_job(job):
+    # Spooled uploads are kept for dead-lettered jobs so they can be requeued
+    path = job['payload'].get('path')
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def fail_job(job, error):
+    if job_queue.fail(job, error):
+        logger.error("Job dead-lettered", extra={'image_id': job['image_id'], 'kind': job['kind'], 'attempts': job['attempts'], 'error': error})
+    else:
+        logger.warning("Job failed, will retry", extra={'image_id': job['image_id'], 'kind': job['kind'], 'attempts': job['attempts'], 'error': error})
+
+def run_job_worker(max_workers=job_max_workers):
+    # Consume the job queue forever, keeping up to max_workers jobs running
+    # in a process pool. A worker process that dies (out of memory, a crash
+    # while decoding an image) breaks the whole pool: every job it held is
+    # failed, so it is retried or dead-lettered like any other failure, and a
+    # new pool takes over.
+    while True:
+        running = {}
+        claimed = []
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            try:
+                while True:
+                    claimed = job_queue.claim(max_workers - len(running))
+                    while claimed:
+                        future = pool.submit(process_job, claimed[0])
+                        running[future] = claimed.pop(0)
+
+                    if not running:
+                        time.sleep(job_poll_interval)
+                        continue
+
+                    done, _ = wait(running, timeout=job_poll_interval, return_when=FIRST_COMPLETED)
+                    broken = None
+                    for future in done:
+                        job = running[future]
+                        try:
+                            job_queue.complete(job['image_id'], future.result())
+                            cleanup_job(job)
+                            logger.info("Job done", extra={'image_id': job['image_id'], 'kind': job['kind']})
+                        except BrokenProcessPool as e:
+                            # Finish the other completed jobs first
+                            broken = e
+                            continue
+                        except Exception as e:
+                            fail_job(job, str(e))
+                        del running[future]
+                    if broken is not None:
+                        raise broken
+            except BrokenProcessPool:
+                lost = list(running.values()) + claimed
+                logger.error("Job worker process died, starting a new pool", extra={'jobs': [job['image_id'] for job in lost]})
+                for job in lost:
+                    fail_job(job, "Worker process died")
+
+@app.cli.command("run-jobs")
+@click.option("--workers", default=job_max_workers, show_default=True, help="Worker processes.")
+def run_jobs_command(workers):
+    """Process queued uploads in a pool of worker processes."""
+    run_job_worker(workers)
+
+@app.cli.command("requeue-dead-jobs")
+def requeue_dead_jobs_command():
+    """Give every dead-lettered job a fresh set of attempts."""
+    click.echo(f"Requeued {job_queue.requeue_dead()} jobs.")
+
+@app.cli.command("import-images")
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option("--checkpoint", default=None, help="File recording imported sources. Defaults to MANIFEST.done.")
+@click.option("--workers", default=import_max_workers, show_default=True, help="Concurrent downloads.")
+def import_images_command(manifest, checkpoint, workers):
+    """Bulk-import images listed in a CSV or JSONL manifest."""
+    import_images(manifest, checkpoint or manifest + '.done', workers)
+
+@app.cli.command("provision")
+def provision_command():
+    """Create any missing S3 bucket and DynamoDB tables."""
+    create_resources()
+
+@app.cli.command("teardown")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def teardown_command(yes):
+    """Delete the S3 bucket and DynamoDB tables."""
+    if not yes:
+        click.confirm("This deletes the bucket and all tables. Continue?", abort=True)
+    delete_resources()
 
 
 if __name__ == "__main__":
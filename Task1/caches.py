@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import zlib
+import fcntl
+import stat
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+class ListingCache:
+    # Thread-safe TTL + LRU cache for gallery listing pages with
+    # stale-while-revalidate refresh on a few background threads. The threads
+    # are long-lived so they keep their per-thread AWS resources (and pooled
+    # connections) from one refresh to the next.
+    backend = 'memory'
+
+    def __init__(self, ttl, stale_ttl, max_entries, refresh_workers=2):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.refresh_workers = refresh_workers
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = None
+        self._executor_pid = None
+        # Bumped on every invalidation so loads that started earlier are discarded
+        self._generation = 0
+        self._counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def get(self, key, loader):
+        entry = self._lookup(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = self._now() - fetched_at
+            if age < self.ttl:
+                self._count('hits')
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._count('stale_hits')
+                self._schedule_refresh(key, loader)
+                return value
+        self._count('misses')
+
+        # Load outside the lock so a slow listing does not block other pages
+        return self._load(key, loader, self._current_generation())
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _schedule_refresh(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            # Started on first use, and again in a forked worker, whose
+            # inherited executor has no threads
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.refresh_workers, thread_name_prefix='listing-refresh')
+                self._executor_pid = os.getpid()
+            executor = self._executor
+        executor.submit(self._refresh, key, loader, self._current_generation())
+
+    def _load(self, key, loader, generation):
+        value = loader()
+        self._store(key, value, generation)
+        return value
+
+    def _refresh(self, key, loader, generation):
+        try:
+            self._load(key, loader, generation)
+            self._count('refreshes')
+        except Exception as e:
+            self._count('refresh_errors')
+            logger.error("Error refreshing cached listing", extra={'cache_key': repr(key), 'error': str(e)})
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    # Storage hooks, overridden by the shared SQLite backend below
+
+    def _now(self):
+        return time.monotonic()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _current_generation(self):
+        with self._lock:
+            return self._generation
+
+    def _store(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (value, self._now())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _entry_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['entries'] = self._entry_count()
+        stats['max_entries'] = self.max_entries
+        stats['backend'] = self.backend
+        return stats
+
+def make_private_dir(path):
+    # Local state is trusted when it is read back (cached pages, job payloads
+    # naming files to open and delete), so it must live in a directory no
+    # other local user can write to. A directory someone else created first,
+    # e.g. under /tmp, is refused rather than used.
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise RuntimeError(f"{path} must be a directory owned by this user and not writable by others")
+    return path
+
+def connect_sqlite(path):
+    make_private_dir(os.path.dirname(os.path.abspath(path)))
+    # WAL mode lets every worker read while one process writes; statements
+    # run in autocommit mode unless a transaction is opened explicitly
+    db = sqlite3.connect(path, timeout=10, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+class SQLiteListingCache(ListingCache):
+    # Listing cache shared by every worker on the host through a SQLite
+    # database in WAL mode. A byte-range lock per page in a side lock file
+    # elects a single process to list the page; the others wait for its result
+    # (on a miss) or keep serving the stale page (during a refresh). POSIX
+    # record locks belong to the whole process, so threads of one worker first
+    # take a thread lock for the same range. Unlike the memory cache, eviction
+    # is FIFO: the oldest fetched pages go first, since tracking recency would
+    # need a write on every hit. Hit/miss counters stay per process.
+    backend = 'sqlite'
+    lock_stripes = 256
+
+    def __init__(self, path, ttl, stale_ttl, max_entries, refresh_workers=2):
+        super().__init__(ttl, stale_ttl, max_entries, refresh_workers)
+        self.path = path
+        self._local = threading.local()
+        self._lock_file = None
+        self._lock_file_pid = None
+        self._range_locks = None
+
+    def _connect(self):
+        # SQLite connections must not cross threads or a fork, so every thread
+        # of every worker opens its own
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = connect_sqlite(self.path)
+            db.execute('CREATE TABLE IF NOT EXISTS listing_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, fetched_at REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS listing_cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO listing_cache_meta (name, value) VALUES ('generation', 0)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _lock_range(self, key, blocking):
+        # POSIX record locks belong to the process and are dropped when any
+        # descriptor for the file is closed, so one descriptor is kept open
+        # per process. The thread locks are striped by range so their number
+        # stays bounded however many page tokens are seen.
+        with self._lock:
+            if self._lock_file is None or self._lock_file_pid != os.getpid():
+                self._lock_file = open(self.path + '.lock', 'a+b')
+                self._lock_file_pid = os.getpid()
+                self._range_locks = [threading.Lock() for _ in range(self.lock_stripes)]
+            fd = self._lock_file.fileno()
+            offset = zlib.crc32(self._key_text(key).encode())
+            thread_lock = self._range_locks[offset % self.lock_stripes]
+
+        if not thread_lock.acquire(blocking):
+            return None
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        except (BlockingIOError, PermissionError):
+            thread_lock.release()
+            return None
+        except BaseException:
+            thread_lock.release()
+            raise
+        return fd, offset, thread_lock
+
+    def _unlock_range(self, lock):
+        fd, offset, thread_lock = lock
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
+        finally:
+            thread_lock.release()
+
+    def _load(self, key, loader, generation):
+        lock = self._lock_range(key, blocking=True)
+        try:
+            # Another worker may have listed this page while we waited
+            entry = self._lookup(key)
+            if entry is not None and self._now() - entry[1] < self.ttl:
+                return entry[0]
+            return super()._load(key, loader, generation)
+        finally:
+            self._unlock_range(lock)
+
+    def _refresh(self, key, loader, generation):
+        lock = self._lock_range(key, blocking=False)
+        if lock is None:
+            # Another worker is already refreshing this page
+            with self._lock:
+                self._refreshing.discard(key)
+            return
+        try:
+            super()._refresh(key, loader, generation)
+        finally:
+            self._unlock_range(lock)
+
+    def _key_text(self, key):
+        return json.dumps(list(key))
+
+    def _now(self):
+        # Wall clock, since fetch times are compared across processes
+        return time.time()
+
+    def _lookup(self, key):
+        row = self._connect().execute(
+            'SELECT value, fetched_at FROM listing_cache WHERE key = ?',
+            (self._key_text(key),)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return decode_cached_value(row[0]), row[1]
+        except ValueError:
+            # Written in an older format; treated as a miss and overwritten
+            return None
+
+    def _current_generation(self):
+        return self._connect().execute("SELECT value FROM listing_cache_meta WHERE name = 'generation'").fetchone()[0]
+
+    def _store(self, key, value, generation):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if self._current_generation() == generation:
+                db.execute(
+                    'INSERT OR REPLACE INTO listing_cache (key, value, fetched_at) VALUES (?, ?, ?)',
+                    (self._key_text(key), encode_cached_value(value), self._now())
+                )
+                evicted = db.execute(
+                    'DELETE FROM listing_cache WHERE key NOT IN (SELECT key FROM listing_cache ORDER BY fetched_at DESC LIMIT ?)',
+                    (self.max_entries,)
+                ).rowcount
+                if evicted:
+                    self._count('evictions', evicted)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def _entry_count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM listing_cache').fetchone()[0]
+
+    def invalidate(self):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM listing_cache')
+            db.execute("UPDATE listing_cache_meta SET value = value + 1 WHERE name = 'generation'")
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        self._count('invalidations')
+
+# Cached pages are stored as JSON, never pickled, so reading the cache file
+# cannot run code. DynamoDB numbers come back as Decimal and are tagged so they
+# round-trip exactly; tuples come back as lists.
+
+def encode_decimal(value):
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError(f"{type(value).__name__} cannot be cached")
+
+def decode_decimal(value):
+    if value.keys() == {'__decimal__'}:
+        return Decimal(value['__decimal__'])
+    return value
+
+def encode_cached_value(value):
+    return json.dumps(value, default=encode_decimal)
+
+def decode_cached_value(text):
+    return json.loads(text, object_hook=decode_decimal)
@@ -0,0 +1,131 @@
+# gunicorn settings for serving the app:
+#     cd Task1 && gunicorn -c gunicorn.conf.py
+import os
+import re
+import time
+import threading
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Requests mostly wait on S3 and DynamoDB, so concurrency comes from threads:
+# one process per core, each serving `threads` requests at once. Boto clients
+# are shared by a worker's threads, so AWS_MAX_POOL_CONNECTIONS should be at
+# least `threads`.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('GUNICORN_WORKERS', str(os.cpu_count() or 2)))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+# Import the app once in the master and fork workers from it. Importing creates
+# no boto clients or threads that must not cross a fork; post_fork has each
+# worker build its own (application.init_worker).
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# Recycle each worker after about max_requests requests; the jitter keeps
+# workers from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+
+# gunicorn's statsd instrumentation sends request counts, durations, status
+# codes and worker counts over UDP to a local statsd agent, which also sums what
+# every worker on the host reports. STATSD_HOST= (empty) turns it off.
+statsd_host = os.environ.get('STATSD_HOST', 'localhost:8125') or None
+statsd_prefix = os.environ.get('STATSD_PREFIX', 'approved_vehicles')
+
+# Seconds between pushes of the app's own counters (AWS calls, caches,
+# metadata writes) from each worker to statsd
+app_metrics_interval = float(os.environ.get('APP_METRICS_INTERVAL', '10'))
+
+# Requests currently being handled by this worker; its threads share it
+_active_requests = 0
+_active_requests_lock = threading.Lock()
+# Counter values already pushed to statsd by this worker
+_pushed_counters = {}
+_push_lock = threading.Lock()
+
+def statsd_enabled(worker):
+    # worker.log is gunicorn's Statsd logger only when statsd_host is set
+    return hasattr(worker.log, 'increment')
+
+def statsd_name(name, labels):
+    parts = [name] + [str(value) for label, value in labels]
+    return 'app.' + '.'.join(re.sub(r'[^A-Za-z0-9_-]+', '_', part).strip('_') or 'root' for part in parts)
+
+def push_app_counters(worker):
+    # Send how much each app counter grew since the last push. statsd adds up
+    # the increments of all workers, so the host-wide totals come for free.
+    from application import metrics
+    with _push_lock:
+        for name, labels, value in metrics.counter_samples():
+            key = (name, labels)
+            delta = value - _pushed_counters.get(key, 0)
+            if delta > 0:
+                worker.log.increment(statsd_name(name, labels), delta)
+                _pushed_counters[key] = value
+
+def run_app_counter_pusher(worker):
+    while True:
+        time.sleep(app_metrics_interval)
+        try:
+            push_app_counters(worker)
+        except Exception:
+            worker.log.exception("Error pushing app counters to statsd")
+
+def request_start_ms(value):
+    # X-Request-Start as set by load balancers and proxies: "t=<timestamp>" or
+    # a bare timestamp, in seconds, milliseconds or microseconds
+    timestamp = float(value.strip().removeprefix('t='))
+    if timestamp > 1e14:
+        return timestamp / 1000
+    if timestamp > 1e11:
+        return timestamp
+    return timestamp * 1000
+
+def post_fork(server, worker):
+    from application import init_worker
+    init_worker()
+    if not statsd_enabled(worker):
+        return
+    worker.log.increment('workers.started', 1)
+    threading.Thread(target=run_app_counter_pusher, args=(worker,), daemon=True).start()
+
+def pre_request(worker, req):
+    global _active_requests
+    if not statsd_enabled(worker):
+        return
+    with _active_requests_lock:
+        _active_requests += 1
+    # Relative gauge updates from every worker add up to the host's total
+    worker.log.gauge('requests.active', '+1')
+
+    # Time spent waiting in the proxy and the listen backlog
+    for header, value in req.headers:
+        if header == 'X-REQUEST-START':
+            try:
+                worker.log.histogram('request.queue_time', max(time.time() * 1000 - request_start_ms(value), 0))
+            except ValueError:
+                pass
+            break
+
+def post_request(worker, req, environ, resp):
+    global _active_requests
+    if not statsd_enabled(worker):
+        return
+    with _active_requests_lock:
+        _active_requests -= 1
+    worker.log.gauge('requests.active', '-1')
+
+def worker_exit(server, worker):
+    # Runs in the worker process as it shuts down
+    from application import metadata_writer
+    metadata_writer.flush()
+    if not statsd_enabled(worker):
+        return
+    push_app_counters(worker)
+    # Keep the host-wide gauge right if requests were cut off
+    if _active_requests:
+        worker.log.gauge('requests.active', f'-{_active_requests}')
+    if worker.nr >= worker.max_requests:
+        worker.log.increment('workers.recycled', 1)
+    worker.log.increment('workers.exited', 1)
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from caches import connect_sqlite
+
+class JobQueue:
+    # Durable local job queue in a SQLite file, one job per image_id. Jobs go
+    # queued -> running -> done, or back to queued with a growing delay when
+    # they fail, until they are dead-lettered as 'dead' after max_attempts.
+    # A job can run more than once (retries, or a consumer that timed out), so
+    # handlers must be safe to re-run. Every completed job bumps a gallery
+    # generation that web workers watch to invalidate their listing caches.
+
+    def __init__(self, path, max_attempts, retry_delay, timeout):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # SQLite connections must not cross threads or a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = connect_sqlite(self.path)
+            db.row_factory = sqlite3.Row
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'image_id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, '
+                'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                'available_at REAL NOT NULL, last_error TEXT, result TEXT, '
+                'created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at)')
+            db.execute('CREATE TABLE IF NOT EXISTS gallery_generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def enqueue(self, image_id, kind, payload):
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (image_id, kind, payload, status, available_at, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (image_id, kind, json.dumps(payload), now, now, now)
+        )
+
+    def claim(self, limit):
+        # Atomically move up to limit ready jobs to 'running'. Jobs left
+        # running past the timeout belonged to a consumer that died and are
+        # handed out again.
+        now = time.time()
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND updated_at <= ?) "
+                "ORDER BY available_at LIMIT ?",
+                (now, now - self.timeout, limit)
+            ).fetchall()
+            for row in rows:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE image_id = ?",
+                    (now, row['image_id'])
+                )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return [dict(row, payload=json.loads(row['payload']), attempts=row['attempts'] + 1) for row in rows]
+
+    def complete(self, image_id, result):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                "UPDATE jobs SET status = 'done', result = ?, last_error = NULL, updated_at = ? WHERE image_id = ?",
+                (json.dumps(result), time.time(), image_id)
+            )
+            db.execute('INSERT INTO gallery_generation (id, value) VALUES (0, 1) ON CONFLICT (id) DO UPDATE SET value = value + 1')
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def generation(self):
+        row = self._connect().execute('SELECT value FROM gallery_generation WHERE id = 0').fetchone()
+        return row[0] if row else 0
+
+    def fail(self, job, error):
+        # Retry with exponential backoff, or dead-letter the job; returns
+        # True when the job will not be retried
+        now = time.time()
+        dead = job['attempts'] >= self.max_attempts
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, available_at = ?, last_error = ?, updated_at = ? WHERE image_id = ?',
+            ('dead' if dead else 'queued', now + self.retry_delay * 2 ** (job['attempts'] - 1), error, now, job['image_id'])
+        )
+        return dead
+
+    def requeue_dead(self):
+        now = time.time()
+        return self._connect().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, updated_at = ? WHERE status = 'dead'",
+            (now, now)
+        ).rowcount
+
+    def status(self, image_id):
+        row = self._connect().execute(
+            'SELECT image_id, kind, status, attempts, last_error, result, created_at, updated_at FROM jobs WHERE image_id = ?',
+            (image_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(row, result=json.loads(row['result']) if row['result'] else None)
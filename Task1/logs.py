@@ -0,0 +1,92 @@
+import os
+import json
+import queue
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from flask import g, has_request_context
+
+# Logs are JSON lines on stderr. Records are formatted by the thread that logs
+# them and written by a background listener, so request threads never block on
+# log I/O; when the queue is full, new records are dropped.
+
+# Attributes every LogRecord has; anything else was passed through extra=
+standard_log_record_attributes = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime', 'request_id', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'request_id': getattr(record, 'request_id', None)
+        }
+        entry.update((name, value) for name, value in record.__dict__.items() if name not in standard_log_record_attributes)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    # Tags records with the current request's ID and keeps sample_rate of the
+    # DEBUG/INFO records; warnings and errors are always kept. Sampling is
+    # decided once per request (g.log_sampled) so a kept request logs
+    # completely.
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            sampled = g.get('log_sampled', True)
+        else:
+            sampled = random.random() < self.sample_rate
+        return sampled or record.levelno >= logging.WARNING
+
+class DroppingQueueHandler(QueueHandler):
+    # Never waits for a full queue, counts what had to be dropped instead. The
+    # listener thread is started by the first record a process logs, so
+    # importing the app starts no thread. It does not survive a fork, so every
+    # process (web worker, job worker) starts its own with a fresh queue.
+    def __init__(self, queue_size):
+        super().__init__(queue.Queue(queue_size))
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._listener = None
+        self._listener_pid = None
+
+    def enqueue(self, record):
+        # Runs under the handler's lock, which logging renews after a fork
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_listener(self):
+        self.queue = queue.Queue(self.queue_size)
+        output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter('%(message)s'))
+        self._listener = QueueListener(self.queue, output)
+        self._listener.start()
+        self._listener_pid = os.getpid()
+
+    def stop_listener(self):
+        # Write out whatever is still queued; a listener inherited over a fork
+        # belongs to the parent and has no thread here
+        with self.lock:
+            if self._listener is not None and self._listener_pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._listener_pid = None
+
+def configure_logger(name, level, handler):
+    log = logging.getLogger(name)
+    log.setLevel(level)
+    log.propagate = False
+    log.addHandler(handler)
+    return log
@@ -0,0 +1,173 @@
+import math
+import time
+import threading
+from collections import deque
+from botocore.utils import determine_content_length
+
+class Metrics:
+    # Process-local counters and histograms, rendered in the Prometheus text
+    # format by /metrics. Labels are tuples of (name, value) pairs. Collectors
+    # add samples computed at scrape time, such as cache and writer stats.
+    def __init__(self, summary_window=1024):
+        self.summary_window = summary_window
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        # buckets are the upper bounds of a histogram, or the quantiles of a
+        # summary computed over its most recent summary_window observations
+        self._metrics[name] = {'kind': kind, 'help': help_text, 'buckets': buckets, 'samples': {}}
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            samples = self._metrics[name]['samples']
+            samples[labels] = samples.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        metric = self._metrics[name]
+        with self._lock:
+            if metric['kind'] == 'summary':
+                window, total, count = metric['samples'].get(labels) or (deque(maxlen=self.summary_window), 0, 0)
+                window.append(value)
+                metric['samples'][labels] = (window, total + value, count + 1)
+                return
+            # Per-bucket counts, then the sum and count of all observations
+            counts = metric['samples'].setdefault(labels, [0] * (len(metric['buckets']) + 2))
+            for index, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def add_collector(self, collector):
+        # collector() returns (name, kind, help, [(labels, value), ...]) tuples
+        self._collectors.append(collector)
+
+    def counter_samples(self):
+        # (name, labels, value) for every counter, including collected ones,
+        # for pushing to statsd
+        with self._lock:
+            samples = [
+                (name, labels, value)
+                for name, metric in self._metrics.items() if metric['kind'] == 'counter'
+                for labels, value in metric['samples'].items()
+            ]
+        for collector in self._collectors:
+            for name, kind, help_text, collected in collector():
+                if kind == 'counter':
+                    samples.extend((name, labels, value) for labels, value in collected)
+        return samples
+
+    def reset(self):
+        # A forked worker starts counting from zero instead of inheriting its
+        # parent's samples (and possibly a held lock)
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric['samples'] = {}
+
+    def render(self):
+        lines = []
+        with self._lock:
+            snapshot = [(name, metric, {labels: copy_sample(value) for labels, value in metric['samples'].items()}) for name, metric in self._metrics.items()]
+        for name, metric, samples in snapshot:
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in sorted(samples.items()):
+                if metric['kind'] == 'summary':
+                    window, total, count = value
+                    for quantile in metric['buckets']:
+                        lines.append(f"{name}{format_labels(labels + (('quantile', str(quantile)),))} {window_quantile(window, quantile)}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                    continue
+                if metric['kind'] != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(metric['buckets'] + ('+Inf',), value[:-2] + [value[-1]]):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        for collector in self._collectors:
+            for name, kind, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+def copy_sample(value):
+    # Copy a sample so it can be rendered outside the lock
+    if isinstance(value, tuple):
+        return (sorted(value[0]),) + value[1:]
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+def window_quantile(window, quantile):
+    # Nearest-rank quantile of a sorted window of observations
+    if not window:
+        return float('nan')
+    return window[max(0, math.ceil(quantile * len(window)) - 1)]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+# Timings of the request being handled by this thread, set by TimingMiddleware
+_request_timing = threading.local()
+
+def current_request_timing():
+    return getattr(_request_timing, 'timing', None)
+
+def set_request_timing(timing):
+    _request_timing.timing = timing
+
+class AWSCallMetrics:
+    # botocore emits these events on every client of a session: before-call
+    # once per API call, then after-call with the parsed response (also for
+    # AWS error responses) or after-call-error when no response was received.
+    # Calls made while handling a request also count towards its aws time.
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def register(self, events):
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call_error)
+
+    def before_call(self, model, params, context, **kwargs):
+        context['metrics_labels'] = (('service', model.service_model.service_name), ('operation', model.name))
+        context['metrics_request_bytes'] = determine_content_length(params.get('body')) or 0
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(self, http_response, parsed, context, **kwargs):
+        outcome = 'ok'
+        if http_response.status_code >= 300:
+            outcome = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        response_bytes = int(http_response.headers.get('content-length') or 0)
+        self.record(context, outcome, retries, response_bytes)
+
+    def after_call_error(self, exception, context, **kwargs):
+        self.record(context, type(exception).__name__, 0, 0)
+
+    def record(self, context, outcome, retries, response_bytes):
+        if 'metrics_start' not in context:
+            return
+        labels = context['metrics_labels']
+        elapsed = time.perf_counter() - context.pop('metrics_start')
+        self.metrics.observe('aws_request_duration_seconds', elapsed, labels)
+        self.metrics.inc('aws_requests_total', labels + (('outcome', outcome),))
+        if retries:
+            self.metrics.inc('aws_retries_total', labels, retries)
+        self.metrics.inc('aws_request_bytes_total', labels, context['metrics_request_bytes'])
+        self.metrics.inc('aws_response_bytes_total', labels, response_bytes)
+        timing = current_request_timing()
+        if timing is not None:
+            timing['aws'] += elapsed
+            timing['aws_calls'] += 1
@@ -0,0 +1,175 @@
+import time
+import zlib
+from functools import partial
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+from metrics import current_request_timing, set_request_timing
+
+# brotli is optional; without it responses are only gzip-compressed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compressible_content_types = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+class CompressionMiddleware:
+    # WSGI middleware compressing text responses on the fly. Responses without
+    # a Content-Length (streamed templates) are flushed chunk by chunk so the
+    # browser can start rendering before the body is complete.
+    def __init__(self, wsgi_app, min_size=1024, gzip_level=6, brotli_quality=5, content_types=compressible_content_types):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.content_types = content_types
+
+    def choose_encoding(self, environ):
+        # The encoding with the highest q-value, br on a tie
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        br = accept.quality('br') if brotli is not None else 0
+        gzip = accept.quality('gzip')
+        if br > 0 and br >= gzip:
+            return 'br'
+        if gzip > 0:
+            return 'gzip'
+        return None
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200') or 'Content-Encoding' in headers:
+            return False
+        if not headers.get('Content-Type', '').startswith(self.content_types):
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        length = headers.get('Content-Length')
+        return length is None or int(length) >= self.min_size
+
+    def compressor(self, encoding):
+        # (compress, flush, finish) callables for one response body
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process, compressor.flush, compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return (
+            compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            lambda: compressor.flush(zlib.Z_FINISH)
+        )
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ) if environ['REQUEST_METHOD'] != 'HEAD' else None
+        response = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = Headers(headers)
+            response['exc_info'] = exc_info
+            return start_response_body
+
+        def start_response_body(data):
+            raise RuntimeError("CompressionMiddleware does not support the write() callable")
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        status, headers = response['status'], response['headers']
+
+        # Caches must keep compressed and identity copies apart, including
+        # for 304s revalidating either one
+        if status.startswith('304') or headers.get('Content-Type', '').startswith(self.content_types):
+            headers.add_header('Vary', 'Accept-Encoding')
+            if len(headers.getlist('Vary')) > 1:
+                headers['Vary'] = ', '.join(dict.fromkeys(
+                    value.strip() for vary in headers.getlist('Vary') for value in vary.split(',')
+                ))
+
+        if encoding is None or not self.should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), response['exc_info'])
+            return app_iter
+
+        streaming = 'Content-Length' not in headers
+        headers.remove('Content-Length')
+        headers['Content-Encoding'] = encoding
+        # The compressed body is no longer byte-identical to the original
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = f"W/{etag}"
+        start_response(status, headers.to_wsgi_list(), response['exc_info'])
+        return self.compress(app_iter, encoding, streaming)
+
+    def compress(self, app_iter, encoding, streaming):
+        compress, flush, finish = self.compressor(encoding)
+        try:
+            for chunk in app_iter:
+                data = compress(chunk)
+                if streaming:
+                    data += flush()
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+class TimingMiddleware:
+    # Times every request and splits it into AWS calls (from the botocore
+    # hooks), template rendering (from Flask's template signals) and the rest
+    # of the app. Server-Timing reports what is known when the headers are
+    # sent; the metrics are recorded once the body has been sent, so streamed
+    # pages include their rendering.
+    def __init__(self, wsgi_app, metrics, server_timing=True):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    def __call__(self, environ, start_response):
+        timing = {'start': time.perf_counter(), 'aws': 0.0, 'aws_calls': 0, 'render': 0.0, 'route': None}
+        set_request_timing(timing)
+
+        def timed_start_response(status, headers, exc_info=None):
+            if self.server_timing:
+                headers.append(('Server-Timing', format_server_timing(timing)))
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.wsgi_app(environ, timed_start_response)
+        except BaseException:
+            self.finish(timing, environ['REQUEST_METHOD'])
+            raise
+        return ClosingIterator(app_iter, partial(self.finish, timing, environ['REQUEST_METHOD']))
+
+    def finish(self, timing, method):
+        set_request_timing(None)
+        total = time.perf_counter() - timing['start']
+        labels = (('route', timing['route'] or 'unmatched'), ('method', method))
+        self.metrics.observe('http_request_duration_seconds', total, labels)
+        for phase, seconds in split_request_time(timing, total).items():
+            self.metrics.inc('http_request_phase_seconds_total', labels + (('phase', phase),), seconds)
+
+def split_request_time(timing, total):
+    return {'aws': timing['aws'], 'render': timing['render'], 'app': max(total - timing['aws'] - timing['render'], 0.0)}
+
+def format_server_timing(timing):
+    total = time.perf_counter() - timing['start']
+    durations = split_request_time(timing, total)
+    return ', '.join([
+        f'aws;dur={durations["aws"] * 1000:.1f};desc="AWS ({timing["aws_calls"]} calls)"',
+        f'render;dur={durations["render"] * 1000:.1f};desc="Templates"',
+        f'app;dur={durations["app"] * 1000:.1f};desc="App"',
+        f'total;dur={total * 1000:.1f}'
+    ])
+
+# Receivers for Flask's before_render_template and template_rendered signals
+
+def start_render_timer(sender, template, context, **extra):
+    timing = current_request_timing()
+    if timing is not None:
+        timing['render_start'] = (time.perf_counter(), timing['aws'])
+
+def stop_render_timer(sender, template, context, **extra):
+    # A streamed template lists the gallery while it renders; those AWS calls
+    # are already counted as aws time
+    timing = current_request_timing()
+    if timing is not None and 'render_start' in timing:
+        started, aws_before = timing.pop('render_start')
+        timing['render'] += time.perf_counter() - started - (timing['aws'] - aws_before)
@@ -0,0 +1,139 @@
+import gzip
+import zlib
+import unittest
+from unittest import mock
+from werkzeug.datastructures import Headers
+from werkzeug.test import create_environ
+import middleware
+from middleware import CompressionMiddleware
+
+body = b'<p>approved vehicle</p>' * 100
+
+def wsgi_app(chunks, status='200 OK', headers=()):
+    def app(environ, start_response):
+        start_response(status, list(headers))
+        return iter(chunks)
+    return app
+
+def call(app, method='GET', accept_encoding='gzip'):
+    # Runs the middleware and returns the status, headers and body chunks as
+    # they were yielded
+    environ = create_environ(method=method, headers={'Accept-Encoding': accept_encoding} if accept_encoding else {})
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = Headers(headers)
+
+    chunks = list(CompressionMiddleware(app)(environ, start_response))
+    return response['status'], response['headers'], chunks
+
+class CompressionMiddlewareTest(unittest.TestCase):
+    def test_compresses_responses_with_a_length(self):
+        app = wsgi_app([body], headers=[('Content-Type', 'text/html'), ('Content-Length', str(len(body)))])
+
+        status, headers, chunks = call(app)
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(b''.join(chunks)), body)
+
+    def test_flushes_every_chunk_of_a_streamed_response(self):
+        parts = [b'<html>', b'<p>first page</p>', b'<p>second page</p>', b'</html>']
+        app = wsgi_app(parts, headers=[('Content-Type', 'text/html')])
+
+        status, headers, chunks = call(app)
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        # Each part can be decoded as soon as its chunk arrives
+        decompressor = zlib.decompressobj(31)
+        for part, chunk in zip(parts, chunks):
+            self.assertEqual(decompressor.decompress(chunk), part)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b''.join(parts))
+
+    def test_merges_vary_and_weakens_strong_etags(self):
+        app = wsgi_app([body], headers=[
+            ('Content-Type', 'text/html'),
+            ('Vary', 'Cookie'),
+            ('Vary', 'Accept-Encoding'),
+            ('ETag', '"abc"')
+        ])
+
+        status, headers, chunks = call(app)
+
+        self.assertEqual(headers.getlist('Vary'), ['Cookie, Accept-Encoding'])
+        self.assertEqual(headers['ETag'], 'W/"abc"')
+
+    def test_keeps_weak_etags(self):
+        app = wsgi_app([body], headers=[('Content-Type', 'text/html'), ('ETag', 'W/"abc"')])
+
+        status, headers, chunks = call(app)
+
+        self.assertEqual(headers['ETag'], 'W/"abc"')
+
+    def test_leaves_small_responses_alone(self):
+        app = wsgi_app([b'tiny'], headers=[('Content-Type', 'text/html'), ('Content-Length', '4'), ('ETag', '"abc"')])
+
+        status, headers, chunks = call(app)
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['ETag'], '"abc"')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(chunks, [b'tiny'])
+
+    def test_leaves_clients_without_gzip_alone(self):
+        app = wsgi_app([body], headers=[('Content-Type', 'text/html')])
+
+        status, headers, chunks = call(app, accept_encoding=None)
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(b''.join(chunks), body)
+
+    def test_leaves_head_requests_alone(self):
+        app = wsgi_app([], headers=[('Content-Type', 'text/html'), ('Content-Length', str(len(body)))])
+
+        status, headers, chunks = call(app, method='HEAD')
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+
+    def test_not_modified_varies_on_encoding(self):
+        app = wsgi_app([], status='304 NOT MODIFIED', headers=[('ETag', 'W/"abc"')])
+
+        status, headers, chunks = call(app)
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(chunks, [])
+
+    def test_leaves_encoded_and_binary_responses_alone(self):
+        encoded = wsgi_app([body], headers=[('Content-Type', 'text/html'), ('Content-Encoding', 'br')])
+        binary = wsgi_app([body], headers=[('Content-Type', 'image/png')])
+
+        self.assertEqual(call(encoded)[1]['Content-Encoding'], 'br')
+        status, headers, chunks = call(binary)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertNotIn('Vary', headers)
+
+class ChooseEncodingTest(unittest.TestCase):
+    def choose(self, accept_encoding):
+        environ = create_environ(headers={'Accept-Encoding': accept_encoding})
+        return CompressionMiddleware(None).choose_encoding(environ)
+
+    def test_follows_the_clients_preference(self):
+        with mock.patch.object(middleware, 'brotli', mock.Mock()):
+            self.assertEqual(self.choose('gzip;q=1.0, br;q=0.1'), 'gzip')
+            self.assertEqual(self.choose('gzip;q=0.5, br'), 'br')
+            self.assertEqual(self.choose('gzip, br'), 'br')
+            self.assertEqual(self.choose('br;q=0, gzip;q=0.1'), 'gzip')
+            self.assertIsNone(self.choose('identity'))
+
+    def test_uses_gzip_without_brotli(self):
+        with mock.patch.object(middleware, 'brotli', None):
+            self.assertEqual(self.choose('br, gzip;q=0.1'), 'gzip')
+            self.assertIsNone(self.choose('br'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import time
+import tempfile
+import unittest
+from jobs import JobQueue
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'jobs.sqlite3')
+
+    def job_queue(self, max_attempts=3, retry_delay=0, timeout=600):
+        return JobQueue(self.path, max_attempts, retry_delay, timeout)
+
+    def test_claim_hands_out_each_job_once(self):
+        jobs = self.job_queue()
+        jobs.enqueue('image-1', 'store_upload', {'path': '/tmp/upload'})
+
+        claimed = jobs.claim(10)
+
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0]['image_id'], 'image-1')
+        self.assertEqual(claimed[0]['payload'], {'path': '/tmp/upload'})
+        self.assertEqual(claimed[0]['attempts'], 1)
+        self.assertEqual(jobs.status('image-1')['status'], 'running')
+        self.assertEqual(jobs.claim(10), [])
+
+    def test_claim_respects_limit(self):
+        jobs = self.job_queue()
+        for number in range(3):
+            jobs.enqueue(f'image-{number}', 'store_upload', {})
+
+        self.assertEqual(len(jobs.claim(2)), 2)
+        self.assertEqual(len(jobs.claim(2)), 1)
+
+    def test_complete_records_result_and_bumps_generation(self):
+        jobs = self.job_queue()
+        jobs.enqueue('image-1', 'store_upload', {})
+        self.assertEqual(jobs.generation(), 0)
+
+        jobs.complete(jobs.claim(1)[0]['image_id'], {'image_id': 'image-1'})
+
+        status = jobs.status('image-1')
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['result'], {'image_id': 'image-1'})
+        self.assertEqual(jobs.generation(), 1)
+        self.assertEqual(jobs.claim(1), [])
+
+    def test_failed_job_waits_for_its_retry_delay(self):
+        jobs = self.job_queue(retry_delay=60)
+        jobs.enqueue('image-1', 'store_upload', {})
+
+        dead = jobs.fail(jobs.claim(1)[0], 'boom')
+
+        self.assertFalse(dead)
+        status = jobs.status('image-1')
+        self.assertEqual((status['status'], status['last_error']), ('queued', 'boom'))
+        self.assertEqual(jobs.claim(1), [])
+
+    def test_failed_job_is_retried_then_dead_lettered(self):
+        jobs = self.job_queue(max_attempts=2)
+        jobs.enqueue('image-1', 'store_upload', {})
+
+        self.assertFalse(jobs.fail(jobs.claim(1)[0], 'first'))
+        retried = jobs.claim(1)
+        self.assertEqual(retried[0]['attempts'], 2)
+        self.assertTrue(jobs.fail(retried[0], 'second'))
+
+        status = jobs.status('image-1')
+        self.assertEqual((status['status'], status['attempts'], status['last_error']), ('dead', 2, 'second'))
+        self.assertEqual(jobs.claim(1), [])
+
+    def test_requeue_dead_resets_attempts(self):
+        jobs = self.job_queue(max_attempts=1)
+        jobs.enqueue('image-1', 'store_upload', {})
+        self.assertTrue(jobs.fail(jobs.claim(1)[0], 'boom'))
+
+        self.assertEqual(jobs.requeue_dead(), 1)
+
+        claimed = jobs.claim(1)
+        self.assertEqual(claimed[0]['attempts'], 1)
+
+    def test_running_job_is_reclaimed_after_timeout(self):
+        jobs = self.job_queue(timeout=0.05)
+        jobs.enqueue('image-1', 'store_upload', {})
+        jobs.claim(1)
+        self.assertEqual(jobs.claim(1), [])
+
+        time.sleep(0.1)
+
+        reclaimed = jobs.claim(1)
+        self.assertEqual(reclaimed[0]['attempts'], 2)
+
+    def test_status_of_unknown_job(self):
+        self.assertIsNone(self.job_queue().status('missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import threading
+import unittest
+from caches import ListingCache
+
+class ListingCacheRefreshTest(unittest.TestCase):
+    def test_stale_pages_are_refreshed_on_long_lived_threads(self):
+        cache = ListingCache(ttl=0, stale_ttl=3600, max_entries=10, refresh_workers=1)
+        refresh_threads = set()
+        refreshed = threading.Semaphore(0)
+
+        def loader(value):
+            def load():
+                if threading.current_thread() is not threading.main_thread():
+                    refresh_threads.add(threading.get_ident())
+                    refreshed.release()
+                return value
+            return load
+
+        for page in range(5):
+            self.assertEqual(cache.get(('page', page), loader(page)), page)
+            # Every page is stale at once, so this schedules a refresh
+            self.assertEqual(cache.get(('page', page), loader(page)), page)
+            self.assertTrue(refreshed.acquire(timeout=5))
+
+        self.assertEqual(len(refresh_threads), 1)
+        self.assertEqual(cache.stats()['refreshes'], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+from unittest import mock
+from botocore.exceptions import ClientError
+import application
+from application import MetadataWriter
+
+table_name = application.approved_images_table_name
+
+def vehicle_item(number):
+    return {'image_id': f'id-{number}', 'image_filename': f'image_{number}.png', 'username': 'user'}
+
+def put_request(item):
+    return {'PutRequest': {'Item': item}}
+
+class FakeDynamoDB:
+    # Answers each batch_write_item call with the next scripted response; a
+    # callable is passed the request and may raise
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.meta = mock.Mock(client=self)
+
+    def batch_write_item(self, RequestItems):
+        self.requests.append(RequestItems)
+        response = self.responses.pop(0) if self.responses else {}
+        return response(RequestItems) if callable(response) else response
+
+class MetadataWriterTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(application, 'metadata_backoff_base', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # A long flush interval keeps the background thread out of the way;
+        # the tests flush explicitly
+        self.writer = MetadataWriter(25, 3600, 3)
+
+    def write(self, dynamodb, items, on_written=None):
+        with mock.patch.object(application, 'get_resource', return_value=dynamodb):
+            for item in items:
+                self.writer.put(table_name, item, on_written)
+            self.writer.flush()
+
+    def test_retries_only_the_unprocessed_items(self):
+        first, second = vehicle_item(1), vehicle_item(2)
+        dynamodb = FakeDynamoDB([{'UnprocessedItems': {table_name: [put_request(second)]}}, {}])
+        written = []
+
+        self.write(dynamodb, [first, second], lambda: written.append(True))
+
+        self.assertEqual(dynamodb.requests, [
+            {table_name: [put_request(first), put_request(second)]},
+            {table_name: [put_request(second)]}
+        ])
+        self.assertEqual(len(written), 2)
+        stats = self.writer.stats()
+        self.assertEqual((stats['written'], stats['failed'], stats['retries'], stats['batches']), (2, 0, 1, 2))
+
+    def test_retries_client_errors(self):
+        def throttled(request_items):
+            raise ClientError({'Error': {'Code': 'ThrottlingException'}}, 'BatchWriteItem')
+        dynamodb = FakeDynamoDB([throttled, {}])
+
+        with self.assertLogs('application', 'WARNING'):
+            self.write(dynamodb, [vehicle_item(1)])
+
+        self.assertEqual(len(dynamodb.requests), 2)
+        self.assertEqual(self.writer.stats()['written'], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        stored, lost = vehicle_item(1), vehicle_item(2)
+        unprocessed = {'UnprocessedItems': {table_name: [put_request(lost)]}}
+        dynamodb = FakeDynamoDB([unprocessed] * 3)
+        written = []
+
+        with self.assertLogs('application', 'ERROR') as logs:
+            with mock.patch.object(application, 'get_resource', return_value=dynamodb):
+                self.writer.put(table_name, stored, lambda: written.append(stored['image_id']))
+                self.writer.put(table_name, lost, lambda: written.append(lost['image_id']))
+                self.writer.flush()
+
+        self.assertEqual(len(dynamodb.requests), 3)
+        # Only the stored item's callback runs
+        self.assertEqual(written, [stored['image_id']])
+        stats = self.writer.stats()
+        self.assertEqual((stats['written'], stats['failed'], stats['retries']), (1, 1, 2))
+        record = logs.records[-1]
+        self.assertEqual(record.items, 1)
+        self.assertEqual(record.unprocessed, [{'table': table_name, 'image_filename': 'image_2.png', 'username': 'user'}])
+
+    def test_coalesces_puts_for_the_same_key(self):
+        old, new = vehicle_item(1), dict(vehicle_item(1), image_id='id-new')
+        dynamodb = FakeDynamoDB([{}])
+        written = []
+
+        self.write(dynamodb, [old, new], lambda: written.append(True))
+
+        self.assertEqual(dynamodb.requests, [{table_name: [put_request(new)]}])
+        self.assertEqual(len(written), 2)
+
+    def test_flush_reports_written_tables(self):
+        flushed = []
+        self.writer.on_flush = flushed.append
+
+        self.write(FakeDynamoDB([{}]), [vehicle_item(1)])
+
+        self.assertEqual(flushed, [{table_name}])
+
+if __name__ == '__main__':
+    unittest.main()
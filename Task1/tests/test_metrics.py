@@ -0,0 +1,31 @@
+import unittest
+from metrics import Metrics, window_quantile
+
+class WindowQuantileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        window = list(range(1, 101))
+        self.assertEqual(window_quantile(window, 0.5), 50)
+        self.assertEqual(window_quantile(window, 0.9), 90)
+        self.assertEqual(window_quantile(window, 0.99), 99)
+        self.assertEqual(window_quantile([1, 2], 0.5), 1)
+        self.assertEqual(window_quantile([7], 0.99), 7)
+
+    def test_empty_window(self):
+        self.assertNotEqual(window_quantile([], 0.5), window_quantile([], 0.5))
+
+class SummaryTest(unittest.TestCase):
+    def test_renders_quantiles_over_the_window(self):
+        metrics = Metrics(summary_window=4)
+        metrics.describe('latency_seconds', 'summary', "Latency.", (0.5,))
+        for value in (100, 1, 2, 3, 4):
+            metrics.observe('latency_seconds', value, (('route', '/'),))
+
+        lines = metrics.render().splitlines()
+
+        # The first observation has left the window but still counts in sum
+        self.assertIn('latency_seconds{route="/",quantile="0.5"} 2', lines)
+        self.assertIn('latency_seconds_sum{route="/"} 110', lines)
+        self.assertIn('latency_seconds_count{route="/"} 5', lines)
+
+if __name__ == '__main__':
+    unittest.main()